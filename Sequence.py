@@ -1,82 +1,202 @@
 """This module contains the Sequence class, which can build a video 
 and manage many versions of individual video elements."""
+import asyncio
+import collections
 import json
-import aiohttp
-import moviepy.editor as mov
+from dataclasses import dataclass
+import database
 import gpt
 import eleven
+import ingest
+import metrics
+import providers
+import render
+import sessions
+from admission import AdmissionController, estimate_tokens
+from cache import GenerationCache
+from pipeline import Pipeline
+from singleflight import SingleFlight
 
 # pylint: disable=W0105 # Useless multiline string
 # pylint: disable=W1514 # Not specifying encoding in open()
-# pylint: disable=W0603 # Global statement
 
 IMAGE_PATH = 'images/'
 AUDIO_PATH = 'audio/'
 OUTPUT_PATH = 'output/'
+CACHE_PATH = 'cache/'
+
+# Size cap of the generation cache, least recently used results are evicted past it.
+MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024
 
-CURRENT_ELEVEN_REQUESTS = 0 # max 3 concurrent
 MAX_CONCURRENT_ELEVEN_REQUESTS = 3
-CURRENT_GPT_REQUESTS = 0 # max 10? concurrent
 MAX_CONCURRENT_GPT_REQUESTS = 3
-CURRENT_DALLE_REQUESTS = 0 # max 10? concurrent
 MAX_CONCURRENT_DALLE_REQUESTS = 3
+# Per-minute budgets, None means unlimited.
+GPT_REQUESTS_PER_MINUTE = 3500
+GPT_TOKENS_PER_MINUTE = 90000
+DALLE_REQUESTS_PER_MINUTE = 50
+
+# Speculative generation, see Segment.prefetch().
+# Speculative requests are sent after every regular request.
+PREFETCH_PRIORITY = 1 << 20
+# Most speculative versions a user can have running or waiting to be used at once
+MAX_PREFETCH_PER_USER = 6
+
+# One admission controller per provider, shared by every Sequence in the process.
+eleven_limiter = AdmissionController("elevenlabs", MAX_CONCURRENT_ELEVEN_REQUESTS)
+gpt_limiter = AdmissionController("gpt", MAX_CONCURRENT_GPT_REQUESTS,
+                                  GPT_REQUESTS_PER_MINUTE, GPT_TOKENS_PER_MINUTE)
+dalle_limiter = AdmissionController("dalle", MAX_CONCURRENT_DALLE_REQUESTS,
+                                    DALLE_REQUESTS_PER_MINUTE)
+
+# Provider requests in flight, see flight_key()
+flights = SingleFlight()
+
+# Speculative requests running per user_id, and the user_id of each running request's task
+prefetch_counts = collections.Counter()
+prefetch_tasks: dict[asyncio.Task, int | None] = {}
+
+# Gives a speculative request's budget back to its user. Runs when the task is done,
+# and right away when it's cancelled, so the slot can be reused before the task has unwound.
+# Only the first call for a task counts.
+def release_prefetch(task):
+    if task in prefetch_tasks:
+        prefetch_counts[prefetch_tasks.pop(task)] -= 1
+
+# Identical requests are answered from disk instead of being paid for again.
+generation_cache = GenerationCache(CACHE_PATH, MAX_CACHE_BYTES)
+
+# Loaded from prompts.json on first use
+prompts = None
 
-prompts = {}
-try:
-    with open('prompts.json', 'r') as f:
-        prompts = json.load(f)
-except FileNotFoundError:
-    print("File not found error: prompts.json")
-except json.JSONDecodeError:
-    print("JSON parse error: prompts.json")
-
-async def wait_for_eleven_concurrency():
-    """Async function that returns when more concurrent ElevenLabs TTS API requests are allowed."""
-    while CURRENT_ELEVEN_REQUESTS >= MAX_CONCURRENT_ELEVEN_REQUESTS:
-        await asyncio.sleep(1)
-    return
-
-async def wait_for_gpt_concurrency():
-    """Async function that returns when more concurrent OpenAI GPT API requests are allowed."""
-    while CURRENT_GPT_REQUESTS >= MAX_CONCURRENT_GPT_REQUESTS:
-        await asyncio.sleep(1)
-    return
-
-async def wait_for_dalle_concurrency():
-    """Async function that returns when more concurrent OpenAI DALL-E API requests are allowed."""
-    while CURRENT_DALLE_REQUESTS >= MAX_CONCURRENT_DALLE_REQUESTS:
-        await asyncio.sleep(1)
-    return
-
-async def concurrent_tts(session, voiceID, text, filepath):
+def get_prompts() -> dict:
+    """Returns the prompt templates, reading prompts.json the first time."""
+    global prompts  # pylint: disable=W0603 # Global statement
+    if prompts is None:
+        prompts = {}
+        try:
+            with open('prompts.json', 'r') as f:
+                prompts = json.load(f)
+        except FileNotFoundError:
+            print("File not found error: prompts.json")
+        except json.JSONDecodeError:
+            print("JSON parse error: prompts.json")
+    return prompts
+
+# Identical requests that are in flight at the same time are only sent once,
+# later callers wait for the first one's result. Each user's requests are kept apart,
+# so nobody's request depends on someone else's key.
+def flight_key(cache_key, client):
+    return (cache_key, client.user_id if client else None)
+
+# Callers that joined another caller's request get its file. Gives them their own copy
+# at the path they asked for, from the cache, so segments never share a file.
+async def own_copy(result, cache_key, filepath):
+    if type(result) == str and result != filepath:
+        return await generation_cache.async_get_file(cache_key, filepath) or result
+    return result
+
+# Lower priority values are sent first. Segments use their index as the priority.
+# Results are cached by request. `variant` tells apart requests that are identical
+# but should give a different result, like regenerating a version from the same text.
+# Segments use the version number being generated as the variant.
+# `client` is a user's providers.ProviderClient. Its key and rate limits are used instead of
+# the process-wide ones. None uses the keys in keys/ and the limiters above.
+async def concurrent_tts(session, voiceID, text, filepath, priority=0, variant=0, client=None):
     """Sends an async API request to ElevenLabs TTS, and 
     waits to do so if maximum concurrent calls have been reached."""
-    global CURRENT_ELEVEN_REQUESTS
-    await wait_for_eleven_concurrency()
-    CURRENT_ELEVEN_REQUESTS += 1
-    result = await eleven.async_tts(session, voiceID, text, filepath)
-    CURRENT_ELEVEN_REQUESTS -= 1
-    return result
+    key = generation_cache.make_key({
+        "provider": "elevenlabs", "voice": voiceID, "text": text,
+        "voice_settings": eleven.voice_settings, "variant": variant
+    })
+    cached = await generation_cache.async_get_file(key, filepath + '.mp3')
+    if cached is not None:
+        return cached
+    async def request():
+        limiter = client.limiter("tts") if client else eleven_limiter
+        async with limiter.slot(priority=priority) as waited:
+            metrics.queue_wait.set(waited)
+            result = await eleven.async_tts(session, voiceID, text, filepath, client and client.key)
+        if type(result) == str:
+            await generation_cache.async_put_file(key, result)
+        return result
+    return await own_copy(await flights.do(flight_key(key, client), request), key, filepath + '.mp3')
+
+# Whole script TTS. Returns (mp3 path, character alignment), see eleven.async_tts_with_timestamps
+async def concurrent_tts_with_timestamps(session, voiceID, text, filepath, priority=0, variant=0, client=None):
+    """Sends an async API request to ElevenLabs TTS with timestamps, and 
+    waits to do so if maximum concurrent calls have been reached."""
+    request = {
+        "provider": "elevenlabs", "voice": voiceID, "text": text,
+        "voice_settings": eleven.voice_settings, "variant": variant, "timestamps": True
+    }
+    key = generation_cache.make_key(request)
+    alignment_key = generation_cache.make_key(dict(request, part="alignment"))
+    cached_alignment = await generation_cache.async_get_text(alignment_key)
+    if cached_alignment is not None:
+        cached = await generation_cache.async_get_file(key, filepath + '.mp3')
+        if cached is not None:
+            return (cached, json.loads(cached_alignment))
+    async def request():
+        limiter = client.limiter("tts") if client else eleven_limiter
+        async with limiter.slot(priority=priority) as waited:
+            metrics.queue_wait.set(waited)
+            result = await eleven.async_tts_with_timestamps(session, voiceID, text, filepath, client and client.key)
+        if result is not False:
+            await generation_cache.async_put_file(key, result[0])
+            await generation_cache.async_put_text(alignment_key, json.dumps(result[1]))
+        return result
+    result = await flights.do(flight_key(key, client), request)
+    if result is False:
+        return False
+    return (await own_copy(result[0], key, filepath + '.mp3'), result[1])
 
-async def concurrent_dalle(session, prompt, filepath):
+async def concurrent_dalle(session, prompt, filepath, priority=0, variant=0, client=None):
     """Sends an async API request to OpenAI DALL-E, and 
     waits to do so if maximum concurrent calls have been reached."""
-    global CURRENT_DALLE_REQUESTS
-    await wait_for_dalle_concurrency()
-    CURRENT_DALLE_REQUESTS += 1
-    result = await gpt.async_dalle(session, prompt, filepath)
-    CURRENT_DALLE_REQUESTS -= 1
-    return result
+    key = generation_cache.make_key({
+        "provider": "dalle", "prompt": prompt, "size": gpt.image_size, "variant": variant
+    })
+    cached = await generation_cache.async_get_file(key, filepath + '.png')
+    if cached is not None:
+        return cached
+    async def request():
+        limiter = client.limiter("dalle") if client else dalle_limiter
+        async with limiter.slot(priority=priority) as waited:
+            metrics.queue_wait.set(waited)
+            result = await gpt.async_dalle(session, prompt, filepath, client and client.key)
+        if type(result) == str:
+            await generation_cache.async_put_file(key, result)
+        return result
+    return await own_copy(await flights.do(flight_key(key, client), request), key, filepath + '.png')
 
-async def concurrent_gpt(session, prompt):
+async def concurrent_gpt(session, prompt, priority=0, variant=0, client=None):
     """Sends an async API request to OpenAI GPT, and 
     waits to do so if maximum concurrent calls have been reached."""
-    global CURRENT_GPT_REQUESTS
-    await wait_for_gpt_concurrency()
-    CURRENT_GPT_REQUESTS += 1
-    result = await gpt.async_gpt(session, prompt)
-    CURRENT_GPT_REQUESTS -= 1
-    return result
+    key = generation_cache.make_key({
+        "provider": "gpt", "model": gpt.use_model, "prompt": prompt, "variant": variant
+    })
+    cached = await generation_cache.async_get_text(key)
+    if cached is not None:
+        return cached
+    async def request():
+        limiter = client.limiter("gpt") if client else gpt_limiter
+        async with limiter.slot(estimate_tokens(prompt), priority) as waited:
+            metrics.queue_wait.set(waited)
+            result = await gpt.async_gpt(session, prompt, client and client.key)
+        if type(result) == str:
+            await generation_cache.async_put_text(key, result)
+        return result
+    return await flights.do(flight_key(key, client), request)
+
+def get_limiter_stats() -> list[dict]:
+    """Returns the queue depth and wait time statistics of every provider and user client."""
+    return [limiter.stats() for limiter in (eleven_limiter, gpt_limiter, dalle_limiter)] \
+        + providers.registry.stats()
+
+def get_cache_stats() -> dict:
+    """Returns the hit and miss counters and size of the generation cache."""
+    return generation_cache.stats()
 
 # Segment class represents a video segment with specific properties.
 # Each segment has 3 elements: Image, Audio, and Text.
@@ -97,6 +217,8 @@ class Segment:
         self.image_list: list[str] = []
         self.text_list: list[str] = []
         self.audio_list: list[str] = []
+        # Export frame and thumbnail paths of each image version, made by ingest.py
+        self.image_assets: list[dict[str, str]] = []
         # Element versions, -1 indicates NO version exists.
         # Versions start at 0, first version will be in xxxx_list[0]
         self.image_version = -1
@@ -104,11 +226,25 @@ class Segment:
         self.audio_version = -1
         # The AsyncIO session, used for API requests
         self.session = None
+        # The user whose API keys and rate limits are used. None uses the keys in keys/
+        self.user_id = None
+        # Speculative next versions being made in the background, see prefetch()
+        # element -> ((version, prompt), task)
+        self.speculative: dict[str, tuple[tuple, asyncio.Task]] = {}
+        # new_* calls in progress
+        self.flights = SingleFlight()
     
-    async def init(self, session, text):
+    # Returns the user's client for "openai" or "elevenlabs", or None to use the keys in keys/
+    def client(self, provider):
+        return providers.get_client(self.user_id, provider)
+
+    def set_initial_text(self, session, text):
         self.session = session
         self.text_list.append(text)
         self.text_version = 0
+
+    async def init(self, session, text):
+        self.set_initial_text(session, text)
         await asyncio.gather(self.new_image(), self.new_audio())
         # await self.new_image()
         # await self.new_audio()
@@ -140,28 +276,86 @@ class Segment:
             return False
         return self.image_list[self.image_version]
     
+    # Asset kinds are "export" or "thumb_<size>", see ingest.py
+    # Falls back to the image itself if the asset wasn't made. Can return false!
+    def get_current_image_asset(self, kind):
+        image = self.get_current_image()
+        if image is False or self.image_version >= len(self.image_assets):
+            return image
+        return self.image_assets[self.image_version].get(kind, image)
+
     def get_current_text(self):
         return self.text_list[self.text_version]
     
     def get_current_audio(self):
         return self.audio_list[self.audio_version]
     
+    # Asks GPT to describe an image for the current text.
+    # Falls back to the text itself if GPT fails.
+    async def new_image_prompt(self, variant=0, priority=None):
+        priority = self.index if priority is None else priority
+        image_prompt = await concurrent_gpt(self.session, get_prompts()['get_image_description'] + self.get_current_text(), priority, variant, self.client(providers.OPENAI))
+        return image_prompt or self.get_current_text()
+
+    # The make_* methods generate a version without adding it to the segment,
+    # so the same code serves regular and speculative generation.
+    # Returns (image path, ingested assets), or False on failure
+    async def make_image(self, new_version, image_prompt=None, priority=None):
+        priority = self.index if priority is None else priority
+        image_prompt = image_prompt or await self.new_image_prompt(new_version, priority)
+        image_filepath = await concurrent_dalle(self.session, image_prompt, IMAGE_PATH + self.path(new_version), priority, new_version, self.client(providers.OPENAI))
+        if type(image_filepath) != str:
+            return False
+        return (image_filepath, await ingest.ingest_image(image_filepath))
+
+    async def make_audio(self, new_version, audio_prompt, priority=None):
+        priority = self.index if priority is None else priority
+        return await concurrent_tts(self.session, eleven.voices['Antoni'], audio_prompt, AUDIO_PATH + self.path(new_version), priority, new_version, self.client(providers.ELEVENLABS))
+
+    async def make_text(self, new_version, text_prompt, priority=None):
+        priority = self.index if priority is None else priority
+        return await concurrent_gpt(self.session, text_prompt, priority, new_version, self.client(providers.OPENAI))
+
+    def regenerate_prompt(self, script):
+        text_prompt = get_prompts()['regenerate_sentence'][0]
+        text_prompt += script
+        text_prompt += get_prompts()['regenerate_sentence'][1]
+        text_prompt += self.get_current_text()
+        text_prompt += get_prompts()['regenerate_sentence'][2]
+        return text_prompt
+
+    # A new_* call identical to one that's still running (eg a double-click) waits for that one
+    # and returns its result, instead of generating and adding a second version.
     async def new_image(self, image_prompt=None):
+        return await self.flights.do(("image", image_prompt), lambda: self.add_new_image(image_prompt))
+
+    async def new_audio(self, audio_prompt=None):
+        return await self.flights.do(("audio", audio_prompt), lambda: self.add_new_audio(audio_prompt))
+
+    async def new_text(self, script=None, text_prompt=None):
+        return await self.flights.do(("text", script, text_prompt), lambda: self.add_new_text(script, text_prompt))
+
+    async def add_new_image(self, image_prompt=None):
         new_version = len(self.image_list)
-        image_prompt = image_prompt or await concurrent_gpt(self.session, prompts['get_image_description'] + self.get_current_text())
-        image_prompt = image_prompt or self.get_current_text()
-        image_filepath = await concurrent_dalle(self.session, image_prompt, IMAGE_PATH + self.path(new_version))
-        if type(image_filepath) == str:
-            self.image_list.append(image_filepath)
-            self.image_version = new_version
-            return image_filepath
-        else:
+        # A speculative image is only made from the current text's own prompt
+        signature = (new_version, self.get_current_text()) if image_prompt is None else None
+        made = await self.take_speculative("image", signature)
+        if made is None:
+            made = await self.make_image(new_version, image_prompt)
+        if made is False:
             return False
+        (image_filepath, assets) = made
+        self.image_list.append(image_filepath)
+        self.image_assets.append(assets)
+        self.image_version = new_version
+        return image_filepath
         
-    async def new_audio(self, audio_prompt=None):
+    async def add_new_audio(self, audio_prompt=None):
         new_version = len(self.audio_list)
         audio_prompt = audio_prompt or self.get_current_text()
-        audio_filepath = await concurrent_tts(self.session, eleven.voices['Antoni'], audio_prompt, AUDIO_PATH + self.path(new_version))
+        audio_filepath = await self.take_speculative("audio", (new_version, audio_prompt))
+        if audio_filepath is None:
+            audio_filepath = await self.make_audio(new_version, audio_prompt)
         if type(audio_filepath) == str:
             self.audio_list.append(audio_filepath)
             self.audio_version = new_version
@@ -169,21 +363,96 @@ class Segment:
         else:
             return False
     
-    async def new_text(self, script=None, text_prompt=None):
+    async def add_new_text(self, script=None, text_prompt=None):
         new_version = len(self.text_list)
         if text_prompt is None:
-            text_prompt = prompts['regenerate_sentence'][0]
-            text_prompt += script
-            text_prompt += prompts['regenerate_sentence'][1]
-            text_prompt += self.get_current_text()
-            text_prompt += prompts['regenerate_sentence'][2]
-        text = await concurrent_gpt(self.session, text_prompt)
+            text_prompt = self.regenerate_prompt(script)
+        text = await self.take_speculative("text", (new_version, text_prompt))
+        if text is None:
+            text = await self.make_text(new_version, text_prompt)
         if type(text) == str:
             self.text_list.append(text)
             self.text_version = new_version
             return text
         else:
             return False
+
+    # Speculative mode: generates the next version of an element in the background,
+    # at a priority below every regular request, so it only uses spare provider capacity.
+    # The version isn't added to the segment. If the matching new_* call comes, it takes the
+    # result (waiting for it if it's still running) instead of sending its own request.
+    # Each speculative request counts against the user's MAX_PREFETCH_PER_USER until it finishes
+    # or is cancelled, even if the segment is dropped. `script` is needed for "text", see new_text().
+    # A speculative version made for a text or version that has changed since is replaced.
+    # Must be called from the event loop. Returns True if the version is being made.
+    def prefetch(self, element, script=None):
+        if element == "image":
+            new_version = len(self.image_list)
+            signature = (new_version, self.get_current_text())
+            make = lambda: self.make_image(new_version, priority=PREFETCH_PRIORITY)
+        elif element == "audio":
+            new_version = len(self.audio_list)
+            signature = (new_version, self.get_current_text())
+            make = lambda: self.make_audio(new_version, self.get_current_text(), PREFETCH_PRIORITY)
+        elif element == "text":
+            if script is None:
+                return False
+            new_version = len(self.text_list)
+            text_prompt = self.regenerate_prompt(script)
+            signature = (new_version, text_prompt)
+            make = lambda: self.make_text(new_version, text_prompt, PREFETCH_PRIORITY)
+        else:
+            raise ValueError(f"Unknown element: {element}")
+        entry = self.speculative.get(element)
+        if entry is not None:
+            if entry[0] == signature:
+                return True
+            # take_speculative would only throw it away
+            self.cancel_prefetch(element)
+        if prefetch_counts[self.user_id] >= MAX_PREFETCH_PER_USER:
+            return False
+        prefetch_counts[self.user_id] += 1
+        task = asyncio.create_task(make())
+        prefetch_tasks[task] = self.user_id
+        # However it ends, even if the segment is dropped
+        task.add_done_callback(release_prefetch)
+        self.speculative[element] = (signature, task)
+        return True
+
+    # Removes the element's speculative version.
+    # Returns its task, or None if there wasn't one.
+    def pop_speculative(self, element):
+        entry = self.speculative.pop(element, None)
+        if entry is None:
+            return None
+        return entry[1]
+
+    # Returns the speculative result if it was made for `signature` (version, prompt),
+    # or None if there's none to use. A speculative version for anything else is out of date
+    # and is cancelled, it would also be using the version number about to be generated.
+    async def take_speculative(self, element, signature):
+        entry = self.speculative.get(element)
+        if entry is None:
+            return None
+        task = self.pop_speculative(element)
+        if entry[0] != signature:
+            task.cancel()
+            release_prefetch(task)
+            return None
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            return None
+        # A failed speculative request is retried as a regular one
+        return None if result is False else result
+
+    def cancel_prefetch(self, element=None):
+        """Cancels the speculative version of an element, or of every element."""
+        for name in [element] if element else list(self.speculative):
+            task = self.pop_speculative(name)
+            if task is not None:
+                task.cancel()
+                release_prefetch(task)
         
     def get_snapshot(self, iv=None, tv=None, av=None):
         iv = iv or self.image_version
@@ -200,6 +469,7 @@ class Segment:
             "index": self.index,
             "images": {
                 "list": self.image_list,
+                "assets": self.image_assets,
                 "current_version": self.image_version
             },
             "text": {
@@ -215,54 +485,148 @@ class Segment:
         
         
 
+@dataclass
+class SegmentEvent:
+    """Reports that an element of a segment finished generating."""
+    index: int
+    element: str            # "image" or "audio"
+    segment: Segment
+    result: str | bool      # The new element path, or False on failure
+    segment_done: bool      # True when this was the segment's last element to finish
+
 class Sequence:
     """Sequence represents a list of Segments which make up a video."""
-    def __init__(self, project_name):
+    # user_id selects the user's own API keys and rate limits, see providers.py
+    def __init__(self, project_name, user_id=None):
         self.name = project_name
+        self.user_id = user_id
+        # Set by save()
+        self.sequence_id = None
         self.segments: list[Segment] = []
-        self.session = aiohttp.ClientSession()
+        # Borrowed from the process-wide pool in sessions.py by open_session()
+        self.session = None
     
+    # Writes the sequence with every segment and version to the database in one transaction.
+    # Returns the new sequence ID, or 0 if the user already has a sequence with this name.
+    def save(self, user_id=None):
+        user_id = user_id if user_id is not None else self.user_id
+        (sequence_id, _) = database.add_full_sequence(user_id, self.name, self.compile_script(),
+                                                      [seg.jsonify() for seg in self.segments])
+        if sequence_id:
+            self.sequence_id = sequence_id
+        return sequence_id
+
     async def open_session(self):
-        self.session = await self.session.__aenter__()
+        self.session = await sessions.get_session()
     
+    # The shared session stays open for other Sequences.
+    # Close it with sessions.close() when the process shuts down.
     async def close_session(self):
-        await self.session.close()
+        self.cancel_prefetch()
+        self.session = None
+
+    # Attributes the API requests made inside the block to this sequence and its user in metrics.py.
+    # Wrap direct calls to Segment methods in it too, eg `with seq.labels(): await seg.new_image()`
+    def labels(self):
+        return metrics.labels(self.name, self.user_id)
     
     def seg_name(self, segment_number):
         return self.name + "_" + str(segment_number)
     
     async def generate_script_from_subject(self, subject=None):
-        prompt = prompts['script_prompt']
+        prompt = get_prompts()['script_prompt']
         if subject is not None: prompt += "\nWrite the script about " + subject
-        return await gpt.async_gpt(self.session, prompt)
+        client = providers.get_client(self.user_id, providers.OPENAI)
+        with self.labels():
+            return await gpt.async_gpt(self.session, prompt, client and client.key)
 
     async def generate_sequence_from_subject(self, subject=None):
         script = await self.generate_script_from_subject(subject)
         if type(script) == bool: return False
         return await self.generate_sequence(script)
     
+    # Generation runs as a pipeline of stages, each with its own worker pool:
+    #   text -> audio
+    #   text -> image description -> image
+    # Work is picked up in segment index order, so the first segments finish first.
+    # With compile_audio, the audio stage is replaced by one "compile" job for the whole script.
+    def build_pipeline(self, segments: list[Segment], compile_audio=False) -> Pipeline:
+        async def describe(seg):
+            with self.labels():
+                return (seg, await seg.new_image_prompt(len(seg.image_list)))
+        async def draw(item):
+            (seg, image_prompt) = item
+            with self.labels():
+                return await seg.new_image(image_prompt)
+        async def speak(seg):
+            with self.labels():
+                return await seg.new_audio()
+        async def compile_script_audio(_):
+            return await self.compile_audio()
+        pipeline = Pipeline()
+        if compile_audio:
+            pipeline.add_stage("compile", compile_script_audio, 1)
+            # Ahead of every segment, it's the longest request
+            pipeline.put("compile", -1, None)
+        else:
+            pipeline.add_stage("audio", speak, MAX_CONCURRENT_ELEVEN_REQUESTS)
+        pipeline.add_stage("describe", describe, MAX_CONCURRENT_GPT_REQUESTS)
+        pipeline.add_stage("image", draw, MAX_CONCURRENT_DALLE_REQUESTS, after="describe")
+        for seg in segments:
+            if not compile_audio:
+                pipeline.put("audio", seg.index, seg)
+            pipeline.put("describe", seg.index, seg)
+        return pipeline
+
     # Warning: Resets sequence before generating
-    async def generate_sequence(self, script: str):
+    # Yields a SegmentEvent as each image and audio element finishes, in completion order.
+    # The segments are in self.segments from the start, so callers can slot results in by index.
+    # compile_audio speaks the whole script in one TTS request, see compile_audio().
+    # Every segment's audio event then arrives at once, when that request is done.
+    async def generate_sequence_stream(self, script: str, compile_audio=False):
+        self.cancel_prefetch()
         self.segments = []
         line_number = 0
-        coroutines = []
         for line in script.splitlines():
             if line in ['', '\n']: continue
             seg = Segment(line_number, self.seg_name(line_number))
-            coroutines.append(seg.init(self.session, line))
+            seg.set_initial_text(self.session, line)
             self.add_segment(seg)
             line_number += 1
-        await asyncio.gather(*coroutines)
+        remaining = {id(seg): {"image", "audio"} for seg in self.segments}
+        pipeline = self.build_pipeline(self.segments, compile_audio)
+        async for (stage, _, item, result) in pipeline.stream():
+            if stage == "compile":
+                results = result or [False] * len(self.segments)
+                for (seg, audio_path) in zip(self.segments, results):
+                    remaining[id(seg)].discard("audio")
+                    yield SegmentEvent(seg.index, "audio", seg, audio_path, not remaining[id(seg)])
+                continue
+            if stage == "describe":
+                if result is not False:
+                    continue
+                # The image stage won't run for this segment
+                stage = "image"
+            seg = item[0] if stage == "image" else item
+            remaining[id(seg)].discard(stage)
+            yield SegmentEvent(seg.index, stage, seg, result, not remaining[id(seg)])
+
+    # Warning: Resets sequence before generating
+    async def generate_sequence(self, script: str, compile_audio=False):
+        async for _ in self.generate_sequence_stream(script, compile_audio):
+            pass
     
     def reindex_segments(self):
         for (i, seg) in enumerate(self.segments):
             seg.index = i
     
     def add_segment(self, segment):
+        segment.user_id = self.user_id
         self.segments.append(segment)
         self.reindex_segments()
      
     def insert_segment(self, segment, index):
+        segment.user_id = self.user_id
         self.segments.insert(index, segment)
         self.reindex_segments()
         
@@ -272,31 +636,54 @@ class Sequence:
         text_prompt = ''
         if not (0 <= index < len(self.segments)): return False
         elif index == 0:    # beginning
-            text_prompt = prompts['generate_sentence_at_beginning'][0]
+            text_prompt = get_prompts()['generate_sentence_at_beginning'][0]
             text_prompt += script
-            text_prompt = prompts['generate_sentence_at_beginning'][1]
+            text_prompt = get_prompts()['generate_sentence_at_beginning'][1]
         elif index == len(self.segments)-1:    # end
-            text_prompt = prompts['generate_sentence_at_end'][0]
+            text_prompt = get_prompts()['generate_sentence_at_end'][0]
             text_prompt += script
-            text_prompt = prompts['generate_sentence_at_end'][1]
+            text_prompt = get_prompts()['generate_sentence_at_end'][1]
         else:   # between
-            text_prompt = prompts['generate_sentence_between'][0]
+            text_prompt = get_prompts()['generate_sentence_between'][0]
             text_prompt += script
-            text_prompt += prompts['generate_sentence_between'][1]
+            text_prompt += get_prompts()['generate_sentence_between'][1]
             text_prompt += self.segments[index-1].get_current_text()
-            text_prompt += prompts['generate_sentence_between'][2]
+            text_prompt += get_prompts()['generate_sentence_between'][2]
             text_prompt += self.segments[index+1].get_current_text()
-            text_prompt += prompts['generate_sentence_between'][3]
+            text_prompt += get_prompts()['generate_sentence_between'][3]
         seg = Segment(index, self.seg_name(index))
-        await seg.init(self.session, text_prompt)
+        seg.user_id = self.user_id
+        with self.labels():
+            await seg.init(self.session, text_prompt)
         self.insert_segment(seg, index);
     
     def remove_segment(self, index):
-        self.segments.pop(index)
+        self.segments.pop(index).cancel_prefetch()
     
     def get_segment(self, index):
         return self.segments[index]
 
+    # Speculative mode, see Segment.prefetch(): starts making the next version of `elements`
+    # for the segments the user is looking at, so regenerating them is near instant.
+    # Speculation for every other segment is cancelled, so call again when the view changes.
+    # Must be called from the event loop. Returns how many versions are being made.
+    def prefetch(self, indices, elements=("image", "audio", "text")):
+        indices = [index for index in indices if 0 <= index < len(self.segments)]
+        for seg in self.segments:
+            if seg.index not in indices:
+                seg.cancel_prefetch()
+        script = self.compile_script() if "text" in elements else None
+        started = 0
+        with self.labels():
+            for index in indices:
+                for element in elements:
+                    started += self.segments[index].prefetch(element, script)
+        return started
+
+    def cancel_prefetch(self):
+        for seg in self.segments:
+            seg.cancel_prefetch()
+
     def compile_script(self):
         script = ''
         for seg in self.segments:
@@ -304,33 +691,60 @@ class Sequence:
             script += '\n'
         return script
     
-    # Future advanced option: "compile audio"
-    #   - Generates audio from the compiled script
-    #   - Uses some library to get timestamped captions for the audio
-    #   - Cuts the audio up into segments based on the timestamps
-    #   - Generates the exported video with the cut pieces of audio matched to the images
-    # This would make the audio sound more matural, but it would be a lot more work
-    def export_video(self, filepath):
-        clips = []
-        seg_count = 0
+    # Returns (image path, audio path) for every segment.
+    # Segments without an image reuse the image before them, or None for a black frame.
+    # Uses the pre-sized export frame from ingest.py when there is one.
+    def segment_media(self) -> list[tuple[str | None, str]]:
+        media = []
+        last_image = None
         for seg in self.segments:
-            audio_clip = mov.AudioFileClip(seg.get_current_audio())
-            image_path = seg.get_current_image()
+            image_path = seg.get_current_image_asset("export")
             if image_path is False:
-                if seg_count == 0:
-                    image_clip = mov.ColorClip(size=(1024, 1024), color=(0, 0, 0))
-                else:
-                    image_path = self.segments[seg_count-1].get_current_image()
-                    image_clip = mov.ImageClip(image_path)
-            else:
-                image_clip = mov.ImageClip(image_path)
-            video_clip = image_clip.set_audio(audio_clip)
-            video_clip.duration = audio_clip.duration
-            video_clip.fps = 5
-            clips.append(video_clip)
-            seg_count += 1
-        final_clip = mov.concatenate_videoclips(clips, method='compose')
-        final_clip.write_videofile(OUTPUT_PATH + filepath + ".mp4")
+                image_path = last_image
+            last_image = image_path
+            media.append((image_path, seg.get_current_audio()))
+        return media
+
+    # "Compile audio": speaks the compiled script in one TTS request instead of one per segment,
+    # which sounds more natural and saves the per-request overhead.
+    # The audio is cut into segments at the pauses between lines using the character timestamps,
+    # and each piece is added to its segment as a new audio version.
+    # Returns the new audio paths in segment order (False for a segment that couldn't be cut),
+    # or False if the request failed.
+    async def compile_audio(self):
+        if not self.segments:
+            return []
+        texts = [seg.get_current_text() for seg in self.segments]
+        variant = max(len(seg.audio_list) for seg in self.segments)
+        client = providers.get_client(self.user_id, providers.ELEVENLABS)
+        with self.labels():
+            result = await concurrent_tts_with_timestamps(self.session, eleven.voices['Antoni'], self.compile_script(),
+                                                          AUDIO_PATH + self.name + "_script_" + str(variant),
+                                                          -1, variant, client)
+        if result is False:
+            return False
+        (script_audio, alignment) = result
+        loop = asyncio.get_running_loop()
+        async def cut(seg, start, end):
+            new_version = len(seg.audio_list)
+            audio_filepath = AUDIO_PATH + seg.path(new_version) + '.mp3'
+            try:
+                await loop.run_in_executor(None, render.slice_audio, script_audio, audio_filepath, start, end)
+            except OSError as error:
+                print(f"Audio slicing error for {audio_filepath}: {error}")
+                return False
+            seg.audio_list.append(audio_filepath)
+            seg.audio_version = new_version
+            return audio_filepath
+        return await asyncio.gather(*(cut(seg, start, end) for (seg, (start, end))
+                                      in zip(self.segments, eleven.split_times(texts, alignment))))
+
+    # Each segment is rendered to its own clip once and cached by render.py,
+    # so re-exporting after a change only renders the changed segments.
+    # workers > 1 renders the segment clips in that many processes at once.
+    def export_video(self, filepath, workers=1):
+        clip_paths = render.render_segment_clips(self.segment_media(), workers=workers)
+        render.concat_clips(clip_paths, OUTPUT_PATH + filepath + ".mp4")
         return OUTPUT_PATH + filepath + ".mp4"
 
 async def sequence_test_generate_video(output_name, topic):
@@ -340,11 +754,11 @@ async def sequence_test_generate_video(output_name, topic):
     await seq.generate_sequence_from_subject(topic)
     seq.export_video(output_name)
     await seq.close_session()
+    await sessions.close()
 
 async def main():
     """Main entry point for async execution. Used for isolated testing."""
-    sequence_test_generate_video("seq-test", "lettuce")
+    await sequence_test_generate_video("seq-test", "lettuce")
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
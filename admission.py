@@ -0,0 +1,176 @@
+"""This module contains the AdmissionController class, which limits how many
+API requests are sent to a provider at once and how many are sent per minute."""
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import time
+
+# Length of the rate limit window, in seconds.
+WINDOW = 60
+
+class AdmissionController:
+    """Admits async API requests to a single provider.
+    Enforces a maximum number of requests in flight, and optional
+    requests-per-minute and tokens-per-minute budgets.
+    Waiting requests are woken as soon as capacity frees up,
+    lowest priority value first, then in FIFO order."""
+    def __init__(self, name: str, max_concurrent: int,
+                 requests_per_minute: int | None = None,
+                 tokens_per_minute: int | None = None):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        # Waiters are a heap of (priority, arrival, future, tokens) entries.
+        self._waiters = []
+        self._arrival = itertools.count()
+        # Timestamps of admitted requests, and (timestamp, tokens) of admitted token usage.
+        self._request_times = collections.deque()
+        self._token_usage = collections.deque()
+        self._tokens_in_window = 0
+        # Timer that wakes waiters when the rate limit window moves.
+        self._timer = None
+        # Statistics
+        self.admitted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def queue_depth(self) -> int:
+        """Returns the number of requests waiting to be admitted."""
+        return sum(1 for waiter in self._waiters if not waiter[2].done())
+
+    def stats(self) -> dict:
+        """Returns a snapshot of the controller's state and wait time statistics."""
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth(),
+            "admitted": self.admitted,
+            "total_wait": self.total_wait,
+            "average_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait
+        }
+
+    def _prune(self, now):
+        while self._request_times and self._request_times[0] <= now - WINDOW:
+            self._request_times.popleft()
+        while self._token_usage and self._token_usage[0][0] <= now - WINDOW:
+            self._tokens_in_window -= self._token_usage.popleft()[1]
+
+    # A request larger than the whole token budget is admitted once the window is empty,
+    # otherwise it would wait forever.
+    def _can_admit(self, tokens, now) -> bool:
+        self._prune(now)
+        if self.in_flight >= self.max_concurrent:
+            return False
+        if self.requests_per_minute is not None \
+                and len(self._request_times) >= self.requests_per_minute:
+            return False
+        if self.tokens_per_minute is not None and self._token_usage \
+                and self._tokens_in_window + tokens > self.tokens_per_minute:
+            return False
+        return True
+
+    # Returns the time at which the rate limit window will have room again,
+    # or None if only the concurrency limit is blocking.
+    def _next_opening(self, tokens, now) -> float | None:
+        opening = None
+        if self.requests_per_minute is not None \
+                and len(self._request_times) >= self.requests_per_minute:
+            opening = self._request_times[0] + WINDOW
+        if self.tokens_per_minute is not None and self._token_usage \
+                and self._tokens_in_window + tokens > self.tokens_per_minute:
+            freed = self._tokens_in_window
+            for (timestamp, used) in self._token_usage:
+                freed -= used
+                if freed + tokens <= self.tokens_per_minute or freed == 0:
+                    opening = max(opening or 0, timestamp + WINDOW)
+                    break
+        if opening is not None and self.in_flight >= self.max_concurrent:
+            return None
+        return opening
+
+    def _admit(self, tokens, now):
+        self.in_flight += 1
+        self._request_times.append(now)
+        if tokens:
+            self._token_usage.append((now, tokens))
+            self._tokens_in_window += tokens
+
+    def _wake_waiters(self):
+        now = time.monotonic()
+        while self._waiters:
+            (_, _, future, tokens) = self._waiters[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if not self._can_admit(tokens, now):
+                opening = self._next_opening(tokens, now)
+                if opening is not None:
+                    self._schedule_wake(opening - now)
+                return
+            heapq.heappop(self._waiters)
+            self._admit(tokens, now)
+            future.set_result(None)
+
+    def _schedule_wake(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(max(delay, 0), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake_waiters()
+
+    async def acquire(self, tokens: int = 0, priority: int = 0) -> float:
+        """Waits until the request may be sent. Returns the time spent waiting in seconds.
+        Requests with a lower priority value are admitted first.
+        Every acquire must be followed by a release."""
+        start = time.monotonic()
+        if not self._waiters and self._can_admit(tokens, start):
+            self._admit(tokens, start)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._arrival), future, tokens))
+            self._wake_waiters()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Admitted right before being cancelled, give the slot back.
+                    self.release()
+                elif future.cancelled():
+                    # It may have been the head of the line, blocking smaller requests behind it.
+                    self._wake_waiters()
+                raise
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self):
+        """Frees a concurrency slot and wakes the next waiting request."""
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int = 0, priority: int = 0):
+        """Async context manager that holds a slot for the duration of the block.
+        The slot is released even if the request raises.
+        Yields the time spent waiting in seconds."""
+        waited = await self.acquire(tokens, priority)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+# Rough token estimate for budgeting, about 4 characters per token in English.
+def estimate_tokens(text: str) -> int:
+    """Returns a rough estimate of the number of tokens in the text."""
+    return len(text) // 4 + 1
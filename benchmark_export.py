@@ -0,0 +1,166 @@
+"""
+This module benchmarks video export with synthetic images and audio, no API calls needed.
+The media is generated up front, then each case exports it in its own process,
+so peak memory is measured per case and only covers the export.
+Both targets export at the requested resolution.
+Results are printed (or appended to a file) as one JSON object per line.
+
+Run via
+python benchmark_export.py --segments 10 50 200 --resolution 1024x1024
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import Sequence
+import mov
+import render
+
+TARGETS = ["sequence", "mov"]
+
+def media_paths(count: int) -> list[tuple[str, str]]:
+    """Returns the (image path, audio path) tuples generate_media writes."""
+    return [(f"images/bench_{i}.png", f"audio/bench_{i}.mp3") for i in range(count)]
+
+def generate_media(count: int, resolution: tuple[int, int], duration: float) -> list[tuple[str, str]]:
+    """Writes `count` synthetic PNG images and MP3 files to images/ and audio/
+    in the current directory. Returns a list of (image path, audio path) tuples."""
+    import numpy
+    from PIL import Image
+    from moviepy.config import get_setting
+    os.makedirs('images', exist_ok=True)
+    os.makedirs('audio', exist_ok=True)
+    (width, height) = resolution
+    rng = numpy.random.default_rng(0)
+    media = media_paths(count)
+    for (i, (image_path, audio_path)) in enumerate(media):
+        # Gradient plus noise, so images don't compress unrealistically well
+        gradient = numpy.linspace(0, 255, width, dtype=numpy.float32)[None, :, None]
+        noise = rng.integers(0, 64, (height, width, 3))
+        pixels = numpy.clip(gradient + noise + i * 7 % 128, 0, 255).astype(numpy.uint8)
+        Image.fromarray(pixels).save(image_path)
+        subprocess.run([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', f'sine=frequency={200 + i % 50 * 10}:duration={duration}',
+                        audio_path], check=True)
+    return media
+
+def export_sequence(media, workers: int) -> str:
+    """Exports the media through Sequence.export_video."""
+    seq = Sequence.Sequence("bench")
+    for (i, (image_path, audio_path)) in enumerate(media):
+        seg = Sequence.Segment(i, seq.seg_name(i))
+        seg.text_list.append("")
+        seg.text_version = 0
+        seg.image_list.append(image_path)
+        seg.image_version = 0
+        seg.audio_list.append(audio_path)
+        seg.audio_version = 0
+        seq.add_segment(seg)
+    return seq.export_video("bench", workers=workers)
+
+def export_mov(media) -> str:
+    """Exports the media through mov.ia_tuple_arr_to_videoclip."""
+    output_path = "output/bench_mov.mp4"
+    clip = mov.ia_tuple_arr_to_videoclip(media, output_path)
+    clip.write_videofile(output_path, fps=5, logger=None)
+    return output_path
+
+# The case's process only exports, so its children are the export's own ffmpeg and worker processes.
+def peak_rss_bytes() -> int:
+    """Returns the peak resident memory of this process or its largest child, in bytes."""
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+def output_resolution(path: str) -> str:
+    """Returns the video size of the file at the path, as WIDTHxHEIGHT."""
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    (width, height) = ffmpeg_parse_infos(path)['video_size']
+    return f"{width}x{height}"
+
+def measure_case(target: str, segments: int, resolution: tuple[int, int],
+                 duration: float, workers: int) -> dict:
+    """Exports the media generate_media wrote to the current directory, and returns the results."""
+    os.makedirs('output', exist_ok=True)
+    media = media_paths(segments)
+    # mov exports at the images' size, render at RENDER_SETTINGS['size'], so match them
+    render.RENDER_SETTINGS = dict(render.RENDER_SETTINGS, size=resolution)
+    start = time.perf_counter()
+    if target == "sequence":
+        output_path = export_sequence(media, workers)
+    else:
+        output_path = export_mov(media)
+    wall = time.perf_counter() - start
+    result = {
+        "target": target,
+        "segments": segments,
+        "resolution": f"{resolution[0]}x{resolution[1]}",
+        "output_resolution": output_resolution(output_path),
+        "segment_duration": duration,
+        "workers": workers,
+        "wall_seconds": wall,
+        "frames_per_second": segments * duration * 5 / wall,
+        "output_bytes": os.path.getsize(output_path),
+        "peak_rss_bytes": peak_rss_bytes()
+    }
+    if target == "sequence":
+        # Nothing changed, so this measures re-exporting from cached clips
+        start = time.perf_counter()
+        export_sequence(media, workers)
+        result["reexport_wall_seconds"] = time.perf_counter() - start
+    return result
+
+def parse_resolution(text: str) -> tuple[int, int]:
+    (width, height) = text.lower().split('x')
+    return (int(width), int(height))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark video export with synthetic media.")
+    parser.add_argument('--segments', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--resolution', type=parse_resolution, nargs='+',
+                        default=[(1024, 1024)], help="WIDTHxHEIGHT")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds of audio per segment")
+    parser.add_argument('--workers', type=int, default=1, help="Workers for Sequence.export_video")
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS)
+    parser.add_argument('--output', help="Append results to this file instead of printing them")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        # Child process, run a single case in the media's directory and report it to the parent
+        print(json.dumps(measure_case(args.case, args.segments[0], args.resolution[0],
+                                      args.duration, args.workers)))
+        return
+
+    for resolution in args.resolution:
+        for segments in args.segments:
+            # The media is generated here, so its ffmpeg processes don't count towards a case's memory
+            with tempfile.TemporaryDirectory(prefix='gpt_mov_bench_') as workdir:
+                repo = os.getcwd()
+                os.chdir(workdir)
+                try:
+                    generate_media(segments, resolution, args.duration)
+                finally:
+                    os.chdir(repo)
+                for target in args.targets:
+                    child = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                            '--case', target, '--segments', str(segments),
+                                            '--resolution', f'{resolution[0]}x{resolution[1]}',
+                                            '--duration', str(args.duration),
+                                            '--workers', str(args.workers)],
+                                           cwd=workdir, capture_output=True, text=True, check=True)
+                    line = child.stdout.strip().splitlines()[-1]
+                    if args.output is None:
+                        print(line, flush=True)
+                    else:
+                        with open(args.output, 'a', encoding='UTF-8') as file:
+                            file.write(line + '\n')
+
+if __name__ == "__main__":
+    main()
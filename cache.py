@@ -0,0 +1,175 @@
+"""This module contains the GenerationCache class, a persistent on-disk cache
+for generated text, images, and audio. Entries are keyed by a hash of the full
+API request, so identical requests are only paid for once.
+The async_* methods do the file work on a worker thread, so cache hits and stores
+never block the event loop."""
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+class GenerationCache:
+    """Content-addressed cache stored in a directory.
+    Every entry is one file named after the request hash.
+    When the total size passes `max_bytes`, the least recently used entries are evicted.
+    Recency is kept in the files' modification times so it survives restarts.
+    Entries are written to a temporary file and renamed into place, so a crash mid-write
+    never leaves a truncated entry that counts as a hit. Safe to use from several threads."""
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> (filename, size), least recently used first. Loaded on first use.
+        self._entries = None
+        self._total_bytes = 0
+        # Guards the index (_entries, _total_bytes), not the file copies
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        """Returns the cache key for a request. The request must be JSON serializable."""
+        encoded = json.dumps(request, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('UTF-8')).hexdigest()
+
+    # Must be called with the lock held
+    def _load(self):
+        if self._entries is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith('.'):
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            found.append((stat.st_mtime, filename, stat.st_size))
+        found.sort()
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        for (_, filename, size) in found:
+            self._entries[filename.split('.')[0]] = (filename, size)
+            self._total_bytes += size
+
+    # Returns the path of the cached file, or None on a miss.
+    def _lookup(self, key) -> str | None:
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            path = os.path.join(self.directory, entry[0])
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Deleted from under us
+                self._forget(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return path
+
+    # Must be called with the lock held
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+
+    # Writes the entry with `write(temp_path)`, then renames it into place and indexes it.
+    # Temporary files start with '.', so _load() skips the ones a crash left behind.
+    def _store(self, key, filename, write):
+        with self._lock:
+            self._load()
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory, prefix='.' + key + '.', suffix='.part')
+        os.close(fd)
+        try:
+            write(temp_path)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, os.path.join(self.directory, filename))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (filename, size)
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            (_, (filename, size)) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    def get_text(self, key: str) -> str | None:
+        """Returns the cached text for the key, or None on a miss."""
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='UTF-8') as file:
+                return file.read()
+        except FileNotFoundError:
+            # Evicted by another thread since the lookup
+            return None
+
+    def put_text(self, key: str, text: str):
+        """Stores text under the key."""
+        def write(temp_path):
+            with open(temp_path, 'w', encoding='UTF-8') as file:
+                file.write(text)
+        self._store(key, key + '.txt', write)
+
+    def get_file(self, key: str, filepath: str) -> str | None:
+        """Copies the cached file for the key to `filepath`.
+        Returns `filepath`, or None on a miss."""
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            shutil.copyfile(path, filepath)
+        except FileNotFoundError:
+            # Evicted by another thread since the lookup
+            return None
+        return filepath
+
+    def put_file(self, key: str, filepath: str):
+        """Stores a copy of the file at `filepath` under the key."""
+        self._store(key, key + os.path.splitext(filepath)[1],
+                    lambda temp_path: shutil.copyfile(filepath, temp_path))
+
+    # The same, run on the event loop's default executor
+    async def async_get_text(self, key: str) -> str | None:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_text, key)
+
+    async def async_put_text(self, key: str, text: str):
+        await asyncio.get_running_loop().run_in_executor(None, self.put_text, key, text)
+
+    async def async_get_file(self, key: str, filepath: str) -> str | None:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_file, key, filepath)
+
+    async def async_put_file(self, key: str, filepath: str):
+        await asyncio.get_running_loop().run_in_executor(None, self.put_file, key, filepath)
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters and the current size of the cache."""
+        with self._lock:
+            self._load()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -1,7 +1,11 @@
 """
 Module for interfacing with the database schema outlined in schema.sql
 """
+import contextlib
+import json
+import os
 import sqlite3
+import threading
 from dataclasses import dataclass
 
 # pylint: disable=W0105 # Useless multiline string
@@ -16,7 +20,7 @@ INNER JOIN segments
     ON segment_id = segments.id
 WHERE sequence_id = <?>
     AND version = text_version
-ORDER BY sequence_index;
+ORDER BY sort_key;
 '''
 
 
@@ -35,7 +39,7 @@ class Segment:
     """Segment dataclass for storing segment information."""
     id: int
     sequence_id: int
-    sequence_index: int
+    sequence_index: int         # Rank in the sequence, from 0. Computed from sort_key, not stored.
     text_version: int
     image_version: int
     audio_version: int
@@ -51,20 +55,135 @@ class Element(Enum):
     AUDIO = "audio"
 
 
-# Initialize the database file
-connection = sqlite3.connect('database.db')
-connection.row_factory = sqlite3.Row
-cursor = connection.cursor()
+DATABASE_PATH = 'database.db'
+# Schema changes made after schema.sql, see migrate()
+MIGRATIONS_PATH = 'migrations/'
+# Segments are ordered by segments.sort_key. New sequences get keys SORT_KEY_GAP apart,
+# and an inserted or moved segment gets the key halfway between its new neighbours,
+# so only that one row is written. A segment's sequence_index is its rank by sort_key.
+SORT_KEY_GAP = 1024
+# A sequence whose keys got this close together is rebalanced in the background
+MIN_SORT_KEY_GAP = 16
+# Seconds a writer waits for another writer's lock before giving up with "database is locked"
+BUSY_TIMEOUT = 5.0
+# Run on every new connection.
+# WAL lets readers keep reading while a writer commits, and with WAL, synchronous=NORMAL
+# only fsyncs at checkpoints, while staying safe against corruption.
+PRAGMAS = [
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "foreign_keys = ON",
+    "cache_size = -16000",      # 16MB page cache per connection (negative is KiB)
+    "mmap_size = 268435456",    # Read through up to 256MB of memory mapped file
+    "temp_store = MEMORY"
+]
+
+# Every thread (eg every Flask request worker) gets its own connection, opened on first use.
+# sqlite3 connections can't be shared between threads, and a shared cursor's lastrowid
+# would be overwritten by other threads' inserts.
+_local = threading.local()
+# The tables are created by the first connection of the process.
+_init_lock = threading.Lock()
+_initialized = False
+
+def connect() -> sqlite3.Connection:
+    """Opens a new connection to the database with the pragmas applied."""
+    # isolation_level=None: statements outside transaction() commit on their own,
+    # and transaction() decides when transactions begin and end.
+    connection = sqlite3.connect(DATABASE_PATH, timeout=BUSY_TIMEOUT, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        connection.execute(f"PRAGMA {pragma};")
+    return connection
+
+def get_connection() -> sqlite3.Connection:
+    """Returns this thread's database connection, opening it and initializing the tables if needed."""
+    global _initialized  # pylint: disable=W0603 # Global statement
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = _local.connection = connect()
+        with _init_lock:
+            if not _initialized:
+                init_database()
+                _initialized = True
+    return connection
+
+def close_connection():
+    """Closes this thread's database connection, if it has one."""
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        connection.close()
+        _local.connection = None
+
+# One transaction per unit of work:
+# with transaction() as cursor:
+#     cursor.execute(...)
+#     cursor.execute(...)
+# BEGIN IMMEDIATE takes the write lock up front, so two writers queue on the busy timeout
+# instead of failing halfway through when both try to upgrade a read lock.
+# A transaction() inside another one joins the outer transaction.
+@contextlib.contextmanager
+def transaction():
+    """Runs the block in one transaction on this thread's connection and yields a cursor.
+    Commits when the block finishes, rolls back if it raises."""
+    connection = get_connection()
+    cursor = connection.cursor()
+    if connection.in_transaction:
+        yield cursor
+        return
+    cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        yield cursor
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
 
 # Initialize tables (if not exists)
-# Executes the schema.sql file
+# Executes the schema.sql file, then applies the migrations
 def init_database():
     """Initializes the database file from schema.sql"""
     script = None
     with open('schema.sql', 'r', encoding='UTF-8') as file:
         script = file.read()
-    cursor.executescript(script)
-    connection.commit()
+    get_connection().executescript(script)
+    migrate()
+
+# Splits an SQL script into statements, so it can run inside a transaction
+# (executescript always commits first).
+def split_statements(script: str) -> list[str]:
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ''
+    return statements
+
+# Migrations are SQL files in MIGRATIONS_PATH named <version>_<description>.sql, eg 001_lookup_indexes.sql
+# The database's PRAGMA user_version is the last version applied.
+# Pending migrations run in order, in one transaction, so a failed migration changes nothing.
+# Returns the database's version after migrating.
+def migrate() -> int:
+    """Applies the migrations the database doesn't have yet."""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_PATH):
+        if filename.endswith('.sql'):
+            migrations.append((int(filename.split('_')[0]), os.path.join(MIGRATIONS_PATH, filename)))
+    migrations.sort()
+    with transaction() as cursor:
+        # Read under the write lock, so two processes starting at once don't both migrate
+        version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+        for (migration_version, path) in migrations:
+            if migration_version <= version:
+                continue
+            with open(path, 'r', encoding='UTF-8') as file:
+                for statement in split_statements(file.read()):
+                    cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {migration_version};")
+            version = migration_version
+    return version
 
 # TODO: hashing
 def secure_password(username: str , password: str) -> str:
@@ -75,188 +194,301 @@ def secure_password(username: str , password: str) -> str:
 
 ### Add functions
 
-# SQL query wrapper that returns false on an integrity error
-def integrity_query(query: str, values: tuple) -> bool:
-    """Executes a query and returns false if it violates constraints like uniqueness."""
+# SQL query wrapper that returns None on an integrity error
+def integrity_query(query: str, values: tuple) -> sqlite3.Cursor | None:
+    """Executes a query in a transaction and returns its cursor,
+    or None if it violates constraints like uniqueness."""
     try:
-        cursor.execute(query, values)
-        connection.commit()
+        with transaction() as cursor:
+            cursor.execute(query, values)
     except sqlite3.IntegrityError:
-        connection.rollback()
-        return False
-    return True
+        return None
+    return cursor
 
 # Returns the id of the new user, or 0 if the user already exists.
 # By default, SQLite starts IDs at 1, so a value of 0 is FALSE.
 # TODO: Change the way passwords are stored and/or validated
 def add_user(username, password) -> int:
     """Adds a user to the database. Returns the new user ID."""
-    result = integrity_query('''
+    cursor = integrity_query('''
                              INSERT INTO users (username, username_case, password)
                              VALUES (?, ?, ?);
                              ''', (username.lower(), username, password))
-    return cursor.lastrowid if result and cursor.lastrowid else 0
+    return cursor.lastrowid if cursor and cursor.lastrowid else 0
 
 # Returns the new sequence ID
 def add_sequence(user_id, sequence_name) -> int:
     """Adds a sequence to the database. Returns the new sequence ID."""
-    result = integrity_query('''
+    cursor = integrity_query('''
                              INSERT INTO sequences (user_id, sequence_name)
                              VALUES (?, ?);
                              ''', (user_id, sequence_name))
-    return cursor.lastrowid if result and cursor.lastrowid else 0
+    return cursor.lastrowid if cursor and cursor.lastrowid else 0
+
+# Functions called with (user_id, key_type) whenever a key is added or changed,
+# eg to drop a cached client that still holds the old key.
+api_key_listeners = []
+
+def add_api_key_listener(listener):
+    """Registers a function to call with (user_id, key_type) when an API key changes."""
+    api_key_listeners.append(listener)
 
 # Modifies key if already exists
 # Returns true if successful
 def add_api_key(user_id: int, key_type: str, key_str: str) -> bool:
     """Adds an API key to the database. Returns true if successful."""
-    result = integrity_query('''
+    cursor = integrity_query('''
                              INSERT INTO api_keys (user_id, key_type, key_str)
                              VALUES (?, ?, ?)
                              ON CONFLICT(user_id, key_type) 
                              DO UPDATE SET key_str = EXCLUDED.key_str;
                              ''', (user_id, key_type, key_str))
-    return result
+    if cursor:
+        for listener in api_key_listeners:
+            listener(user_id, key_type)
+    return bool(cursor)
 
 # sequence_index outside [0, length] will be put on the closest extreme.
 # Unspecified index == length
 # All element versions start at 0, meaning NO version.
-# Function appropriately increases indices >= insertion index
+# Segments at and after the index move down one, without their rows being written.
 # Returns new segment ID
 def add_segment(sequence_id, sequence_index = None) -> int:
     """Adds a segment to the sequence at the specified index. Returns the new segment ID."""
-    max_index = get_segment_count(sequence_id)
-    if sequence_index is None:
-        sequence_index = max_index
-    else:
-        if sequence_index >= max_index:
-            sequence_index = max_index
-        elif sequence_index <= 0:
-            sequence_index = 0
-    if sequence_index != max_index:
-        # Increase the indices of other segments before inserting
-        cursor.execute('''
-                       UPDATE segments
-                       SET sequence_index = sequence_index + 1
-                       WHERE sequence_id = ?
-                           AND sequence_index >= ?;
-                       ''', (sequence_id, sequence_index))
-    # Insertion
-    result = integrity_query('''
-                             INSERT INTO segments (sequence_id, sequence_index)
-                             VALUES (?, ?);
-                             ''', (sequence_id, sequence_index))
-    return_id = cursor.lastrowid if result and cursor.lastrowid else 0
-    return return_id
+    try:
+        with transaction() as cursor:
+            sort_key = new_sort_key(cursor, sequence_id, sequence_index)
+            # Insertion
+            cursor.execute('''
+                           INSERT INTO segments (sequence_id, sort_key)
+                           VALUES (?, ?);
+                           ''', (sequence_id, sort_key))
+    except sqlite3.IntegrityError:
+        return 0
+    return cursor.lastrowid or 0
 
 
 # Setting "switch" to true will automatically select this new version in the segment.
 # Returns the version assigned.
+# The version is allocated by incrementing segments.{element}_count, in the same transaction as the insert,
+# so it takes constant time and two writers can't get the same version.
+# Returns 0 if the segment doesn't exist.
 def add_segment_element(segment_id: int, element: Element, content: str, switch: bool = False) -> int:
     """Adds a segment element with an incremented version number. Returns the new version number."""
-    next_version = 1 + get_segment_element_version_count(segment_id, element)
-    cursor.execute(f'''
-                   INSERT INTO segment_{element.value}
-                   (segment_id, content, version)
-                   VALUES (?, ?, ?);
-                   ''', (segment_id, content, next_version))
-    if switch:
-        change_segment_element_version(segment_id, element, next_version)
+    with transaction() as cursor:
+        # The right hand sides see the row before the update, so {element}_count + 1 is the new version
+        row = cursor.execute(f'''
+                             UPDATE segments
+                             SET {element.value}_count = {element.value}_count + 1,
+                                 {element.value}_version = CASE WHEN ? THEN {element.value}_count + 1
+                                                                ELSE {element.value}_version END
+                             WHERE id = ?
+                             RETURNING {element.value}_count;
+                             ''', (switch, segment_id)).fetchone()
+        if row is None:
+            return 0
+        next_version = row[0]
+        cursor.execute(f'''
+                       INSERT INTO segment_{element.value}
+                       (segment_id, content, version)
+                       VALUES (?, ?, ?);
+                       ''', (segment_id, content, next_version))
     return next_version
 
+# Writes a whole sequence in one transaction, with one batched INSERT per table,
+# instead of a transaction (and COUNT query) per segment and element.
+# `segments` are in sequence order, in the shape of Sequence.py's Segment.jsonify():
+# {"text": {"list": [...], "current_version": 0}, "images": {...}, "audio": {...}}
+# Lists are version 1, 2, ... in the database, and a current_version of -1 is version 0 (NO version).
+# Returns (sequence ID, [segment IDs in order]), or (0, []) if the user already has a sequence with that name.
+def add_full_sequence(user_id: int, sequence_name: str, script: str | None,
+                      segments: list[dict]) -> tuple[int, list[int]]:
+    """Adds a sequence with all of its segments and element versions. Returns the new IDs."""
+    elements = {Element.TEXT: "text", Element.IMAGE: "images", Element.AUDIO: "audio"}
+    try:
+        with transaction() as cursor:
+            cursor.execute('''
+                           INSERT INTO sequences (user_id, sequence_name, script)
+                           VALUES (?, ?, ?);
+                           ''', (user_id, sequence_name, script))
+            sequence_id = cursor.lastrowid
+            cursor.executemany('''
+                               INSERT INTO segments (sequence_id, sort_key,
+                                                     text_version, image_version, audio_version,
+                                                     text_count, image_count, audio_count)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                               ''', [(sequence_id, (index + 1) * SORT_KEY_GAP,
+                                      segment["text"]["current_version"] + 1,
+                                      segment["images"]["current_version"] + 1,
+                                      segment["audio"]["current_version"] + 1,
+                                      len(segment["text"]["list"]),
+                                      len(segment["images"]["list"]),
+                                      len(segment["audio"]["list"]))
+                                     for (index, segment) in enumerate(segments)])
+            # executemany doesn't report each row's ID, but the sequence is new,
+            # so its segments are exactly the rows just inserted
+            segment_ids = [row[0] for row in cursor.execute('''
+                                                            SELECT id FROM segments
+                                                            WHERE sequence_id = ?
+                                                            ORDER BY sort_key;
+                                                            ''', (sequence_id,))]
+            for (element, key) in elements.items():
+                cursor.executemany(f'''
+                                   INSERT INTO segment_{element.value}
+                                   (segment_id, content, version)
+                                   VALUES (?, ?, ?);
+                                   ''', [(segment_id, content, version)
+                                         for (segment_id, segment) in zip(segment_ids, segments)
+                                         for (version, content) in enumerate(segment[key]["list"], 1)])
+    except sqlite3.IntegrityError:
+        return (0, [])
+    return (sequence_id, segment_ids)
+
 ### Modify functions
 
 # Returns true if successful
 def change_username(user_id, new_username) -> bool:
     """Changes the username of a user. Returns True if successful."""
-    cursor.execute('''
-                   UPDATE users
-                   SET username = ?, username_case = ?
-                   WHERE id = ?;
-                   ''', (new_username.lower(), new_username, user_id))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute('''
+                       UPDATE users
+                       SET username = ?, username_case = ?
+                       WHERE id = ?;
+                       ''', (new_username.lower(), new_username, user_id))
     return bool(cursor.rowcount)
 
 # Returns true if successful
 def change_sequence_name(sequence_id, new_sequence_name) -> bool:
     """Changes the name of a sequence. Returns True if successful."""
-    cursor.execute('''
-                   UPDATE sequences
-                   SET sequence_name = ?
-                   WHERE id = ?;
-                   ''', (new_sequence_name, sequence_id))
-    connection.commit()
+    with transaction() as cursor:
+        cursor.execute('''
+                       UPDATE sequences
+                       SET sequence_name = ?
+                       WHERE id = ?;
+                       ''', (new_sequence_name, sequence_id))
     return bool(cursor.rowcount)
 
 # Moves a segment to a new index
 # Returns the new index, or -1 if unsucessful
-# algorithm:
-#   Set segment index to -1
-#   Set all indices >= old_index --
-#   Increase all indices >= new_index
-#   Set segment index to new_index
-# There is a way to optimize this, but it doesn't sound fun.
+# The segment is taken out, then put back in at new_index, like list.insert(new_index, list.pop(old_index)).
+# Only the moved segment's row is written, the indices of the others follow from the sort keys.
 def change_segment_index(segment_id, new_index) -> bool:
     """Moves a segment to a new index. Changes the indices of other segments accordingly. 
     Returns True if successful."""
-    # Get sequence_id because we need it for increasing indices
-    result = cursor.execute('''
-                            SELECT sequence_id, sequence_index FROM segments
-                            WHERE id = ?;
-                            ''', (segment_id,))
-    row = result.fetchone()
-    if row is None:
-        return False
-    sequence_id = row['sequence_id']
-    old_index = row['sequence_index']
-    
-    # Set index to -1
-    result = cursor.execute('''
-                            UPDATE segments
-                            SET sequence_index = -1
-                            WHERE id = ?;
-                            ''', (segment_id,))
-    
-    # Decrease all indices above old_index
-    # Leaves indices above new_index unchanged
-    cursor.execute('''
-                   UPDATE segments
-                   SET sequence_index = sequence_index - 1
-                   WHERE sequence_id = ?
-                       AND sequence_index >= ?;
-                   ''', (sequence_id, old_index))
-    
-    # Increase the indices of other segments before inserting
-    cursor.execute('''
-                   UPDATE segments
-                   SET sequence_index = sequence_index + 1
-                   WHERE sequence_id = ?
-                       AND sequence_index >= ?;
-                   ''', (sequence_id, new_index))
-    # Insert
-    result = cursor.execute('''
-                            UPDATE segments
-                            SET sequence_index = ?
-                            WHERE id = ?;
-                            ''', (new_index, segment_id))
-    connection.commit()
+    with transaction() as cursor:
+        # Get sequence_id because we need it for finding the neighbours
+        result = cursor.execute('''
+                                SELECT sequence_id FROM segments
+                                WHERE id = ?;
+                                ''', (segment_id,))
+        row = result.fetchone()
+        if row is None:
+            return False
+        sort_key = new_sort_key(cursor, row['sequence_id'], new_index, segment_id)
+        cursor.execute('''
+                       UPDATE segments
+                       SET sort_key = ?
+                       WHERE id = ?;
+                       ''', (sort_key, segment_id))
     return bool(cursor.rowcount)
 
+# Returns the sort key for a segment placed at `index` in the sequence (None or past the end: last),
+# halfway between the keys of its new neighbours. `segment_id` is the segment being moved, if any,
+# which doesn't count as a neighbour. Must be called in a transaction, with the cursor.
+# If there's no room between the neighbours, the sequence is rebalanced first (O(n), rare).
+# If there's little room left, it's rebalanced in the background after this transaction.
+def new_sort_key(cursor: sqlite3.Cursor, sequence_id: int, index: int | None = None,
+                 segment_id: int = 0) -> int:
+    """Returns a sort key that puts a segment at the index in the sequence."""
+    # The keys before and at the index
+    keys = []
+    if index is not None:
+        index = max(index, 0)
+        keys = [row[0] for row in cursor.execute('''
+                                                 SELECT sort_key FROM segments
+                                                 WHERE sequence_id = ?
+                                                     AND id != ?
+                                                 ORDER BY sort_key
+                                                 LIMIT 2 OFFSET ?;
+                                                 ''', (sequence_id, segment_id, max(index - 1, 0)))]
+        if index == 0:
+            keys = [0] + keys[:1]
+    if len(keys) < 2:
+        # Last in the sequence
+        if not keys:
+            row = cursor.execute('''
+                                 SELECT sort_key FROM segments
+                                 WHERE sequence_id = ?
+                                     AND id != ?
+                                 ORDER BY sort_key DESC
+                                 LIMIT 1;
+                                 ''', (sequence_id, segment_id)).fetchone()
+            keys = [row[0] if row is not None else 0]
+        return keys[0] + SORT_KEY_GAP
+    (before, after) = keys
+    if after - before < 2:
+        rebalance_sort_keys(cursor, sequence_id)
+        return new_sort_key(cursor, sequence_id, index, segment_id)
+    sort_key = (before + after) // 2
+    if min(sort_key - before, after - sort_key) < MIN_SORT_KEY_GAP:
+        schedule_rebalance(sequence_id)
+    return sort_key
+
+# Spaces the sequence's sort keys SORT_KEY_GAP apart again, keeping their order.
+def rebalance_sort_keys(cursor: sqlite3.Cursor, sequence_id: int):
+    """Rewrites every sort key of the sequence, evenly spaced."""
+    segment_ids = [row[0] for row in cursor.execute('''
+                                                    SELECT id FROM segments
+                                                    WHERE sequence_id = ?
+                                                    ORDER BY sort_key;
+                                                    ''', (sequence_id,))]
+    cursor.executemany('''
+                       UPDATE segments
+                       SET sort_key = ?
+                       WHERE id = ?;
+                       ''', [((index + 1) * SORT_KEY_GAP, segment_id)
+                             for (index, segment_id) in enumerate(segment_ids)])
+
+# Sequences with a background rebalance pending
+_rebalancing: set[int] = set()
+_rebalancing_lock = threading.Lock()
+
+# The rebalance starts once the caller's transaction commits, since it waits for the write lock.
+def schedule_rebalance(sequence_id: int):
+    """Rebalances the sequence's sort keys in a background thread, once."""
+    with _rebalancing_lock:
+        if sequence_id in _rebalancing:
+            return
+        _rebalancing.add(sequence_id)
+    threading.Thread(target=rebalance_in_background, args=(sequence_id,), daemon=True).start()
+
+def rebalance_in_background(sequence_id: int):
+    try:
+        with transaction() as cursor:
+            rebalance_sort_keys(cursor, sequence_id)
+    except sqlite3.Error as error:
+        print(f"Rebalancing sequence {sequence_id} failed: {error}")
+    finally:
+        with _rebalancing_lock:
+            _rebalancing.discard(sequence_id)
+        close_connection()
+
 # Does not check if the version exists.
 def change_segment_element_version(segment_id: int, element: Element, version: int) -> bool:
     """Changes the active version of a segment element. Returns true if successful."""
-    cursor.execute(f'''
-                   UPDATE segments
-                   SET {element.value}_version = ?
-                   WHERE id = ?;
-                   ''', (version, segment_id))
+    with transaction() as cursor:
+        cursor.execute(f'''
+                       UPDATE segments
+                       SET {element.value}_version = ?
+                       WHERE id = ?;
+                       ''', (version, segment_id))
     return bool(cursor.rowcount)
 
 ### Get functions
 # All get functions will return None if the entry doesn't exist.
 def get_id_from_username(username: str) -> int | None:
     """Returns the user ID of the given username."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT id FROM users
                             WHERE username = ?;
                             ''', (username.lower(),))
@@ -265,7 +497,7 @@ def get_id_from_username(username: str) -> int | None:
 
 def get_username_from_id(user_id: int) -> str | None:
     """Returns the username of the given user ID."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT username_case FROM users
                             WHERE id = ?;
                             ''', (user_id,))
@@ -275,7 +507,7 @@ def get_username_from_id(user_id: int) -> str | None:
 def get_api_key(user_id: int, key_type: str) -> str | None:
     """Returns the API key of the given type belonging to the user.
     Current types are 'openai' and 'elevenlabs'."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT key_str FROM api_keys
                             WHERE user_id = ? AND key_type = ?;
                             ''', (user_id, key_type))
@@ -284,17 +516,17 @@ def get_api_key(user_id: int, key_type: str) -> str | None:
 
 def get_sequences(user_id: int) -> list[Sequence]:
     """Returns a list of Sequence objects belonging to the user."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT * FROM sequences
                             WHERE user_id = ?;
                             ''', (user_id,))
     rows = result.fetchall()
-    return [Sequence(row['id'], row['user_id'], row['name'], row['script']) for row in rows]
+    return [Sequence(row['id'], row['user_id'], row['sequence_name'], row['script']) for row in rows]
     
 
 def get_sequence(sequence_id: int) -> Sequence | None:
     """Returns a Sequence object with the given id."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT * FROM sequences
                             WHERE id = ?;
                             ''', (sequence_id,))
@@ -305,8 +537,11 @@ def get_sequence(sequence_id: int) -> Sequence | None:
 
 def get_segment(segment_id: int) -> Segment | None:
     """Returns a Segment object with the given id."""
-    result = cursor.execute('''
-                            SELECT * FROM segments
+    result = get_connection().execute('''
+                            SELECT *, (SELECT COUNT(*) FROM segments AS other
+                                       WHERE other.sequence_id = segments.sequence_id
+                                           AND other.sort_key < segments.sort_key) AS sequence_index
+                            FROM segments
                             WHERE id = ?;
                             ''', (segment_id,))
     row = result.fetchone()
@@ -316,30 +551,85 @@ def get_segment(segment_id: int) -> Segment | None:
                       row['text_version'], row['image_version'], row['audio_version'])
     return segment
 
+# The whole project in one statement: the sequence, and per segment (in order) every version of each element.
+# json_object/json_group_array results lose their JSON type when they leave a subquery,
+# so they're wrapped in json() to nest as JSON instead of as strings.
+# Lists are in version order because the aggregated subqueries are.
+PROJECT_QUERY = '''
+SELECT sequences.id, sequences.sequence_name, sequences.script,
+    (SELECT json_group_array(json(segment)) FROM (
+        SELECT json_object(
+            'images', json_object(
+                'list', json((SELECT json_group_array(content) FROM (
+                    SELECT content FROM segment_image
+                    WHERE segment_id = segments.id
+                    ORDER BY version))),
+                'current_version', segments.image_version - 1),
+            'text', json_object(
+                'list', json((SELECT json_group_array(content) FROM (
+                    SELECT content FROM segment_text
+                    WHERE segment_id = segments.id
+                    ORDER BY version))),
+                'current_version', segments.text_version - 1),
+            'audio', json_object(
+                'list', json((SELECT json_group_array(content) FROM (
+                    SELECT content FROM segment_audio
+                    WHERE segment_id = segments.id
+                    ORDER BY version))),
+                'current_version', segments.audio_version - 1)
+        ) AS segment
+        FROM segments
+        WHERE segments.sequence_id = sequences.id
+        ORDER BY segments.sort_key)
+    ) AS segments
+FROM sequences
+WHERE sequences.id = ?;
+'''
+
+# Returns the project in the shape of GET /api/projects/<project-id> in server.py:
+# {"name": name, "id": id, "script": script, "sequence": [segment, ...]}
+# with each segment in the shape of Sequence.py's Segment.jsonify(), except for the image "assets",
+# which aren't stored. The inverse of add_full_sequence: version 0 (NO version) is current_version -1.
+def get_project(sequence_id: int) -> dict | None:
+    """Returns a sequence with all of its segments and element versions, in one query."""
+    row = get_connection().execute(PROJECT_QUERY, (sequence_id,)).fetchone()
+    if row is None:
+        return None
+    segments = json.loads(row['segments'])
+    return {
+        "name": row['sequence_name'],
+        "id": row['id'],
+        "script": row['script'],
+        "sequence": [dict(index=index, **segment) for (index, segment) in enumerate(segments)]
+    }
+
 def get_segments(sequence_id: int) -> list[Segment] | None:
     """Returns a list of Segment objects in a sequence in index order."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT * from segments
                             WHERE sequence_id = ?
-                            ORDER BY sequence_index;
+                            ORDER BY sort_key;
                             ''', (sequence_id,))
     segments = []
-    for row in result.fetchall():
-        segments.append(Segment(row['id'], row['sequence_id'], row['sequence_index'],
+    for (sequence_index, row) in enumerate(result.fetchall()):
+        segments.append(Segment(row['id'], row['sequence_id'], sequence_index,
                       row['text_version'], row['image_version'], row['audio_version']))
     return segments
 
 def get_segment_from_index(sequence_id: int, sequence_index: int) -> Segment | None:
     """Returns the segment at the index in a sequence."""
-    result = cursor.execute('''
+    if sequence_index < 0:
+        return None
+    result = get_connection().execute('''
                             SELECT * FROM segments
                             WHERE sequence_id = ?
-                                AND sequence_index = ?;
+                            ORDER BY sort_key
+                            LIMIT 1 OFFSET ?;
                             ''', (sequence_id, sequence_index))
     row = result.fetchone()
     if row is None:
         return None
-    segment = Segment(row['id'], row['sequence_id'], row['sequence_index'],
+    segment = Segment(row['id'], row['sequence_id'], sequence_index,
                       row['text_version'], row['image_version'], row['audio_version'])
     return segment
 
@@ -349,16 +639,16 @@ def get_segment_element(segment_id: int, element: Element, version: int = 0) ->
     If version is unspecified, the function will return the version specified by the segment."""
     if version == 0:
         # If version is unspecified, get the version specified in segment.{element.value}_version
-        result = cursor.execute(f'''
-                        SELECT content FROM sequence_{element.value}
+        result = get_connection().execute(f'''
+                        SELECT content FROM segment_{element.value}
                         INNER JOIN segments
                             ON segment_id = segments.id
                         WHERE segment_id = ? 
                             AND version = {element.value}_version;
                         ''', (segment_id,))
     else:
-        result = cursor.execute(f'''
-                        SELECT content FROM sequence_{element.value}
+        result = get_connection().execute(f'''
+                        SELECT content FROM segment_{element.value}
                         INNER JOIN segments
                             ON segment_id = segments.id
                         WHERE segment_id = ? 
@@ -369,7 +659,7 @@ def get_segment_element(segment_id: int, element: Element, version: int = 0) ->
 
 def get_segment_count(sequence_id: int) -> int:
     """Returns the number of segments in a sequence."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT COUNT(*) FROM segments
                             WHERE sequence_id = ?;
                             ''', (sequence_id,))
@@ -378,11 +668,12 @@ def get_segment_count(sequence_id: int) -> int:
     
 def get_segment_element_version_count(segment_id: int, element: Element) -> int:
     """Returns the number of versions of a segment element."""
-    result = cursor.execute(f'''
-                            SELECT COUNT(*) FROM segment_{element.value}
-                            WHERE segment_id = ?;
+    result = get_connection().execute(f'''
+                            SELECT {element.value}_count FROM segments
+                            WHERE id = ?;
                             ''', (segment_id,))
-    return result.fetchone()[0]
+    row = result.fetchone()
+    return row[0] if row is not None else 0
 
 
 
@@ -390,7 +681,7 @@ def get_segment_element_version_count(segment_id: int, element: Element) -> int:
 
 def does_username_exist(username: str) -> bool:
     """Returns true if the username exists in the database. Case insensitive."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT id FROM users
                             WHERE username = ?;
                             ''', (username.lower(),))
@@ -398,7 +689,7 @@ def does_username_exist(username: str) -> bool:
 
 def does_user_id_exist(user_id: int) -> bool:
     """Returns true if the user id exists in the database."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT id FROM users
                             WHERE id = ?;
                             ''', (user_id,))
@@ -407,12 +698,12 @@ def does_user_id_exist(user_id: int) -> bool:
 def does_sequence_name_exist(sequence_name: str, user_id: int = 0) -> bool:
     """Returns true if the sequence name exists in the database. Case insensitive."""
     if user_id == 0:
-        result = cursor.execute('''
+        result = get_connection().execute('''
                                 SELECT id FROM sequences
                                 WHERE sequence_name = ?;
                                 ''', (sequence_name.lower(),))
     else:
-        result = cursor.execute('''
+        result = get_connection().execute('''
                                 SELECT id FROM sequences
                                 WHERE sequence_name = ?
                                     AND user_id = ?;
@@ -421,7 +712,7 @@ def does_sequence_name_exist(sequence_name: str, user_id: int = 0) -> bool:
 
 def does_sequence_id_exist(sequence_id: int) -> bool:
     """Returns true if the sequence id exists in the database."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT id FROM sequences
                             WHERE id = ?;
                             ''', (sequence_id,))
@@ -429,7 +720,7 @@ def does_sequence_id_exist(sequence_id: int) -> bool:
 
 def does_segment_id_exist(segment_id: int) -> bool:
     """Returns true if the segment id exists in the database."""
-    result = cursor.execute('''
+    result = get_connection().execute('''
                             SELECT id FROM segments
                             WHERE id = ?;
                             ''', (segment_id,))
@@ -437,18 +728,21 @@ def does_segment_id_exist(segment_id: int) -> bool:
 
 def does_sequence_index_exist(sequence_id: int, sequence_index: int) -> bool:
     """Returns true if a segment exists at the given sequence index."""
-    result = cursor.execute('''
+    if sequence_index < 0:
+        return False
+    result = get_connection().execute('''
                             SELECT id FROM segments
                             WHERE sequence_id = ?
-                                AND sequence_index = ?;
+                            ORDER BY sort_key
+                            LIMIT 1 OFFSET ?;
                             ''', (sequence_id, sequence_index))
     return bool(result.fetchone())
 
 def does_segment_element_version_exist(segment_id: int, element: Element, version: int) -> bool:
     """Returns true if a segment element exists with the specified version.
     Segment element versions begin at 1."""
-    result = cursor.execute(f'''
-                            SELECT id FROM segment_{element.value}
+    result = get_connection().execute(f'''
+                            SELECT version FROM segment_{element.value}
                             WHERE segment_id = ?
                                 AND version = ?;
                             ''', (segment_id, version))
@@ -456,15 +750,13 @@ def does_segment_element_version_exist(segment_id: int, element: Element, versio
 
 def drop_all():
     """Dangerous function that drops all tables in the database. Do not run in production."""
-    cursor.execute("DROP TABLE IF EXISTS api_keys")
-    cursor.execute("DROP TABLE IF EXISTS segment_text")
-    cursor.execute("DROP TABLE IF EXISTS segment_image")
-    cursor.execute("DROP TABLE IF EXISTS segment_audio")
-    cursor.execute("DROP TABLE IF EXISTS segments")
-    cursor.execute("DROP TABLE IF EXISTS sequences")
-    cursor.execute("DROP TABLE IF EXISTS users")
-
-
-
-
-init_database()
+    with transaction() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS api_keys")
+        cursor.execute("DROP TABLE IF EXISTS segment_text")
+        cursor.execute("DROP TABLE IF EXISTS segment_image")
+        cursor.execute("DROP TABLE IF EXISTS segment_audio")
+        cursor.execute("DROP TABLE IF EXISTS segments")
+        cursor.execute("DROP TABLE IF EXISTS sequences")
+        cursor.execute("DROP TABLE IF EXISTS users")
+        # So init_database() applies the migrations again
+        cursor.execute("PRAGMA user_version = 0")
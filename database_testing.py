@@ -15,7 +15,8 @@ def generate_api_key(user_id, key_type):
     return database.add_api_key(user_id, key_type, key_str)
 
 def generate_empty_sequence(user_id):
-    sequence_name = ' '.join(fake.words(nb=2))
+    # Unique, since a user can't have two sequences with the same name
+    sequence_name = ' '.join(fake.unique.words(nb=2))
     return database.add_sequence(user_id, sequence_name)
 
 def generate_empty_segment(sequence_id):
@@ -66,9 +67,61 @@ def populate():
         generate_api_key(user_id, 'openai')
         generate_api_key(user_id, 'elevenlabs')
 
+# Runs every lookup in database.py against the populated database, and checks with
+# EXPLAIN QUERY PLAN that none of its statements scans a whole table.
+# Returns the statements that do.
+def test_query_plans():
+    """Tests that the queries in database.py use indexes"""
+    connection = database.get_connection()
+    statements = []
+    connection.set_trace_callback(statements.append)
+    user_id = database.get_id_from_username(database.get_username_from_id(1))
+    sequence = database.get_sequence(1)
+    database.get_sequences(user_id)
+    database.get_api_key(user_id, 'openai')
+    segment = database.get_segments(sequence.id)[2]
+    database.get_segment(segment.id)
+    database.get_segment_from_index(sequence.id, 3)
+    database.get_segment_count(sequence.id)
+    database.get_project(sequence.id)
+    database.does_username_exist('nobody')
+    database.does_user_id_exist(user_id)
+    database.does_sequence_name_exist(sequence.name)
+    database.does_sequence_name_exist(sequence.name, user_id)
+    database.does_sequence_id_exist(sequence.id)
+    database.does_segment_id_exist(segment.id)
+    database.does_sequence_index_exist(sequence.id, 3)
+    for element in database.Element:
+        database.get_segment_element(segment.id, element)
+        database.get_segment_element(segment.id, element, 1)
+        database.get_segment_element_version_count(segment.id, element)
+        database.does_segment_element_version_exist(segment.id, element, 1)
+        database.change_segment_element_version(segment.id, element, 1)
+        database.add_segment_element(segment.id, element, 'query plan test')
+    database.add_segment(sequence.id, 2)
+    database.change_segment_index(segment.id, 5)
+    database.change_sequence_name(sequence.id, sequence.name)
+    connection.set_trace_callback(None)
+
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+    scans = []
+    for statement in statements:
+        if statement.split(None, 1)[0].upper() not in ('SELECT', 'UPDATE', 'DELETE'):
+            continue
+        for row in connection.execute(f"EXPLAIN QUERY PLAN {statement}"):
+            detail = row['detail']
+            # Scans of subquery results and constant rows are fine, only tables count
+            if detail.startswith('SCAN ') and detail.split()[1] in tables:
+                scans.append(f"{detail}: {' '.join(statement.split())}")
+    print(f"Checked the query plans of {len(statements)} statements, {len(scans)} full scans.")
+    for scan in scans:
+        print(scan)
+    return scans
+
 database.drop_all()
 database.init_database()
 populate()
+if test_query_plans(): exit(1)
 
 # Expected output:
 # 1 2 3 4 5 6 7 8 -> 1 2 3 5 6 4 7 8
@@ -1,25 +1,55 @@
 """This module contains the necessary functions to interface with Eleven Labs TTS service."""
-import requests
+# pylint: disable=W0603 # Global statement
+# pylint: disable=C0415 # Import outside toplevel, requests is only imported by the sync functions that use it
+import base64
+import os
+import metrics
+import resilience
+import sessions
+from media_sink import MediaSink
 
 # The API key. API key is stored in a text file, not in this repo.
 # You must create the file yourself.
 # Create the file keys/elevenkey.txt and paste the API key with no additional content.
 elevenkey = ''
-# get key from elevenkey.txt
-with open('keys/elevenkey.txt', 'r+') as f:
-    elevenkey = f.readline().strip()
 
+# The key is read on first use, so importing this module doesn't need the key file.
+def get_key() -> str:
+    """Returns the ElevenLabs API key, reading it from keys/elevenkey.txt the first time."""
+    global elevenkey
+    if not elevenkey:
+        with open('keys/elevenkey.txt', 'r', encoding='UTF-8') as f:
+            elevenkey = f.readline().strip()
+    return elevenkey
+
+# The base URL of the ElevenLabs API. Can be pointed at a stand-in server,
+# like mock_provider.py, with the ELEVENLABS_BASE_URL environment variable or set_base_url().
+baseURL = os.environ.get('ELEVENLABS_BASE_URL', 'https://api.elevenlabs.io/v1')
 # The URL for the API call that gets a list of available voices.
-voicesURL = 'https://api.elevenlabs.io/v1/voices'
+voicesURL = baseURL + '/voices'
 # The URL for the API call that generates and returns an audio file from text.
-ttsURL = 'https://api.elevenlabs.io/v1/text-to-speech/'
+ttsURL = baseURL + '/text-to-speech/'
+
+def set_base_url(url: str):
+    """Points every ElevenLabs request at a different server, eg http://127.0.0.1:8080/v1"""
+    global baseURL, voicesURL, ttsURL
+    baseURL = url.rstrip('/')
+    voicesURL = baseURL + '/voices'
+    ttsURL = baseURL + '/text-to-speech/'
+
+# Voice settings sent with every TTS request.
+voice_settings = {
+    "stability": 0.5,
+    "similarity_boost": 0
+}
 
 # Returns a string on success, False on failure
 def request_voice_list() -> str | bool:
     headers = {
         'Content-Type': 'application/json',
-        'xi-api-key': elevenkey
+        'xi-api-key': get_key()
     }
+    import requests
     response = requests.get(voicesURL, headers=headers)
     if response.ok:
         return response.json()['voices']
@@ -33,15 +63,13 @@ def tts(voiceID, text, filepath) -> str | bool:
     headers = {
         "Accept": "audio/mpeg",
         "Content-Type": "application/json",
-        'xi-api-key': elevenkey
+        'xi-api-key': get_key()
     }
     data = {
         "text": text,
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0
-        }
+        "voice_settings": voice_settings
     }
+    import requests
     response = requests.post(ttsURL + voiceID, headers=headers, json=data)
     if response.ok:
         filepath = filepath + '.mp3'
@@ -95,47 +123,125 @@ def generate_test_list():
 # Async versions don't take up the entire thread when waiting for a response.
 # This means we can run concurrent API calls and get content FASTER.
 # As a concequence, we do have to rate limit our calls to a certain calls/min
+# Passing None as the session borrows the process-wide shared session from sessions.py
+# `key` is the API key to send, eg a user's own key from providers.py. None uses keys/elevenkey.txt
+
+# Requests are retried with backoff through resilience.py, and fail fast while the provider is down
+# for their API key (one user exhausting their quota doesn't stop the others).
+# Every request is timed and recorded by metrics.py.
 
 # Returns a string on success, False on failure
-async def async_request_voice_list(session) -> str | bool:
+async def async_request_voice_list(session, key=None) -> str | bool:
+    session = session or await sessions.get_session()
     headers = {
         'Content-Type': 'application/json',
-        'xi-api-key': elevenkey
+        'xi-api-key': key or get_key()
     }
     # response = requests.get(voicesURL, headers=headers)
-    async with session.get(voicesURL, headers=headers) as response:
-        if response.ok:
-            return (await response.json())['voices']
-        else:
-            print('Error: ' + await response.text())
-            return False
+    async def attempt():
+        with metrics.track("elevenlabs", "voices") as record:
+            async with session.get(voicesURL, headers=headers) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    body = await response.json()
+                    record.bytes = len(await response.read())
+                    record.ok = True
+                    return body['voices']
+                error = await response.text()
+                record.bytes = len(error)
+                resilience.raise_for_retry(response, error)
+                print('Error: ' + error)
+                return False
+    return await resilience.call("elevenlabs", attempt, key)
 
 # Returns a string on success, False on failure
-async def async_tts(session, voiceID, text, filepath) -> str | bool:
-    print("Fetching tts...")
+async def async_tts(session, voiceID, text, filepath, key=None) -> str | bool:
+    session = session or await sessions.get_session()
     headers = {
         "Accept": "audio/mpeg",
         "Content-Type": "application/json",
-        'xi-api-key': elevenkey
+        'xi-api-key': key or get_key()
     }
     data = {
         "text": text,
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0
-        }
+        "voice_settings": voice_settings
     }
-    async with session.post(ttsURL + voiceID, headers=headers, json=data) as response:
-        if response.ok:
-            filepath = filepath + '.mp3'
-            with open(filepath, 'wb') as f:
-                async for chunk in response.content.iter_chunked(4096):
-                    f.write(chunk)
-            print("File created! (?) " + filepath)
-            return filepath
-        else:
-            print('TTS Error: ' + await response.text())
-            return False
+    async def attempt():
+        print("Fetching tts...")
+        with metrics.track("elevenlabs", "tts", voiceID) as record:
+            async with session.post(ttsURL + voiceID, headers=headers, json=data) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    mp3_filepath = filepath + '.mp3'
+                    async with MediaSink(mp3_filepath) as sink:
+                        async for chunk in response.content.iter_chunked(4096):
+                            record.bytes += len(chunk)
+                            await sink.write(chunk)
+                    print("File created! (?) " + mp3_filepath)
+                    record.characters = len(text)
+                    record.ok = True
+                    return mp3_filepath
+                error = await response.text()
+                record.bytes = len(error)
+                resilience.raise_for_retry(response, error)
+                print('TTS Error: ' + error)
+                return False
+    return await resilience.call("elevenlabs", attempt, key)
+
+
+# Same as async_tts, but also returns the character timestamps of the audio, eg
+# {"characters": ["H", "i"], "character_start_times_seconds": [0.0, 0.1],
+#  "character_end_times_seconds": [0.1, 0.2]}
+# Returns (mp3 path, alignment) on success, False on failure
+async def async_tts_with_timestamps(session, voiceID, text, filepath, key=None) -> tuple[str, dict] | bool:
+    session = session or await sessions.get_session()
+    headers = {
+        "Content-Type": "application/json",
+        'xi-api-key': key or get_key()
+    }
+    data = {
+        "text": text,
+        "voice_settings": voice_settings
+    }
+    async def attempt():
+        print("Fetching tts with timestamps...")
+        with metrics.track("elevenlabs", "tts_timestamps", voiceID) as record:
+            async with session.post(ttsURL + voiceID + '/with-timestamps', headers=headers, json=data) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    body = await response.json()
+                    record.bytes = len(await response.read())
+                    mp3_filepath = filepath + '.mp3'
+                    async with MediaSink(mp3_filepath) as sink:
+                        await sink.write(base64.b64decode(body['audio_base64']))
+                    print("File created! (?) " + mp3_filepath)
+                    record.characters = len(text)
+                    record.ok = True
+                    return (mp3_filepath, body['alignment'])
+                error = await response.text()
+                record.bytes = len(error)
+                resilience.raise_for_retry(response, error)
+                print('TTS Error: ' + error)
+                return False
+    return await resilience.call("elevenlabs", attempt, key)
+
+# `alignment` is the character timing of the texts spoken together, each followed by a newline.
+# Pieces are cut halfway through the pause between texts.
+def split_times(texts: list[str], alignment: dict) -> list[tuple[float, float | None]]:
+    """Returns the (start, end) seconds of each text in the audio. The last end is None, the end of the audio."""
+    starts = alignment['character_start_times_seconds']
+    ends = alignment['character_end_times_seconds']
+    last = len(starts) - 1
+    cuts = [0.0]
+    offset = 0
+    for text in texts[:-1]:
+        next_offset = offset + len(text) + 1
+        # Clamped, in case the alignment came back shorter than the text
+        text_end = ends[min(offset + max(len(text) - 1, 0), last)]
+        next_start = starts[min(next_offset, last)]
+        cuts.append(max((text_end + next_start) / 2, cuts[-1]))
+        offset = next_offset
+    return list(zip(cuts, cuts[1:] + [None]))
 
 
 # Quick test
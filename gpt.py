@@ -4,33 +4,58 @@ Specifically, the GPT chat-completion interface, and DALL-E image generation.
 NOTE that DALL-E generations are MUCH MORE EXPENSIVE than chat completions.
 Like, 10 cents per image or something crazy.
 """
-import requests
+# pylint: disable=W0603 # Global statement
+# pylint: disable=C0415 # Import outside toplevel, requests is only imported by the sync functions that use it
+import os
+import metrics
+import resilience
+import sessions
+from media_sink import MediaSink
 
 # The API key. API key is stored in a text file, not in this repo.
 # You must create the file yourself.
 # Create the file keys/openaikey.txt and paste the API key with no additional content.
 openaikey = ''
-# get key from openaikey.txt
-with open('keys/openaikey.txt', 'r+') as f:
-    openaikey = f.readline().strip()
 
+# The key is read on first use, so importing this module doesn't need the key file.
+def get_key() -> str:
+    """Returns the OpenAI API key, reading it from keys/openaikey.txt the first time."""
+    global openaikey
+    if not openaikey:
+        with open('keys/openaikey.txt', 'r', encoding='UTF-8') as f:
+            openaikey = f.readline().strip()
+    return openaikey
 
+
+# The base URL of the OpenAI API. Can be pointed at a stand-in server,
+# like mock_provider.py, with the OPENAI_BASE_URL environment variable or set_base_url().
+baseurl = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
 # The API URL for chat completion
-gpturl = 'https://api.openai.com/v1/chat/completions'
+gpturl = baseurl + '/chat/completions'
 # The API URL for DALL-E image generation
-dalleurl = 'https://api.openai.com/v1/images/generations'
+dalleurl = baseurl + '/images/generations'
+
+def set_base_url(url: str):
+    """Points every OpenAI request at a different server, eg http://127.0.0.1:8080/v1"""
+    global baseurl, gpturl, dalleurl
+    baseurl = url.rstrip('/')
+    gpturl = baseurl + '/chat/completions'
+    dalleurl = baseurl + '/images/generations'
 
 
 models = ["gpt-3.5-turbo", "gpt-4", "gpt-4-32k"]
 use_model = models[0]
 
+image_sizes = ["256x256", "512x512", "1024x1024"]
+image_size = image_sizes[2]
+
 # TODO: Return None on failure, not a bool false
 def gpt(prompt) -> str | bool:
     """
     Makes a request to the OpenAI chat completion API.
     Returns a string on success, or a False on failure.
     """
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + openaikey}
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + get_key()}
     request = {
         "model": use_model,
         "messages": [
@@ -41,6 +66,7 @@ def gpt(prompt) -> str | bool:
         ]
     }
     print("Sending GPT request...")
+    import requests
     response = requests.post(gpturl, headers=headers, json=request)
     if response.ok:
         print("Got GPT response!")
@@ -56,6 +82,7 @@ def download_image(url, filename) -> str | bool:
     Returns the filename on success, or False on failure.
     """
     print("Downloading image...")
+    import requests
     response = requests.get(url)
     if response.ok:
         print("Response OK! Writing to file " + filename + "...")
@@ -69,13 +96,14 @@ def download_image(url, filename) -> str | bool:
 
 # Returns a string on success, False on failure
 def dalle(prompt: str, filepath) -> str | bool:
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + openaikey}
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + get_key()}
     request = {
         "prompt": prompt,
         "n": 1,
-        "size": "1024x1024" #256x256, 512x512, or 1024x1024
+        "size": image_size
     }
     print(f"Getting DALL-E image from prompt: {prompt}")
+    import requests
     response = requests.post(dalleurl, headers=headers, json=request)
     if response.ok:
         url = response.json()["data"][0]['url']
@@ -92,10 +120,17 @@ def dalle(prompt: str, filepath) -> str | bool:
 # Async versions don't take up the entire thread when waiting for a response.
 # This means we can run concurrent API calls and get content FASTER.
 # As a concequence, we do have to rate limit our calls to a certain calls/min
+# Passing None as the session borrows the process-wide shared session from sessions.py
+# `key` is the API key to send, eg a user's own key from providers.py. None uses keys/openaikey.txt
+
+# Requests are retried with backoff through resilience.py, and fail fast while the provider is down
+# for their API key (one user exhausting their quota doesn't stop the others).
+# Every request is timed and recorded by metrics.py.
 
 # Returns a string on success, False on failure
-async def async_gpt(session, prompt) -> str | bool:
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + openaikey}
+async def async_gpt(session, prompt, key=None) -> str | bool:
+    session = session or await sessions.get_session()
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + (key or get_key())}
     request = {
         "model": use_model,
         "messages": [
@@ -105,48 +140,80 @@ async def async_gpt(session, prompt) -> str | bool:
             }
         ]
     }
-    print("Sending GPT request...")
-    async with session.post(gpturl, headers=headers, json=request) as response:
-        if response.ok:
-            print("Got GPT response!")
-            return (await response.json())['choices'][0]['message']['content']
-        else:
-            error = await response.text()
-            # Recurse if failed due to external issue.
-            if "That model is currently overloaded with other requests" in error["error"]["message"]:
-                return await async_gpt(session, prompt)
-            print('GPT Request Error: ' + await response.text())
-            return False
+    async def attempt():
+        print("Sending GPT request...")
+        with metrics.track("openai", "gpt", use_model) as record:
+            async with session.post(gpturl, headers=headers, json=request) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    print("Got GPT response!")
+                    body = await response.json()
+                    record.bytes = len(await response.read())
+                    usage = body.get('usage', {})
+                    record.prompt_tokens = usage.get('prompt_tokens', 0)
+                    record.completion_tokens = usage.get('completion_tokens', 0)
+                    record.ok = True
+                    return body['choices'][0]['message']['content']
+                error = await response.text()
+                record.bytes = len(error)
+                # Retry if failed due to external issue, like the model being overloaded.
+                resilience.raise_for_retry(response, error)
+                print('GPT Request Error: ' + error)
+                return False
+    return await resilience.call("gpt", attempt, key)
 
 # Returns a string on success, False on failure
 async def async_download_image(session, url, filename) -> str | bool:
-    print("Downloading image...")
-    async with session.get(url) as response:
-        if response.ok:
-            print("Response OK! Writing to file " + filename + "...")
-            with open(filename, 'wb') as file:
-                file.write(await response.read())
-                print('File saved successfully.')
-            return filename
-        else:
-            print('Download Image Error: ' + await response.text())
-            return False
+    session = session or await sessions.get_session()
+    async def attempt():
+        print("Downloading image...")
+        with metrics.track("openai", "image_download") as record:
+            async with session.get(url) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    print("Response OK! Writing to file " + filename + "...")
+                    async with MediaSink(filename) as sink:
+                        async for chunk in response.content.iter_chunked(65536):
+                            record.bytes += len(chunk)
+                            await sink.write(chunk)
+                    print('File saved successfully.')
+                    record.ok = True
+                    return filename
+                error = await response.text()
+                record.bytes = len(error)
+                resilience.raise_for_retry(response, error)
+                print('Download Image Error: ' + error)
+                return False
+    return await resilience.call("image_download", attempt)
 
 # Returns a string on success, False on failure
-async def async_dalle(session, prompt: str, filepath) -> str | bool:
-    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + openaikey}
+async def async_dalle(session, prompt: str, filepath, key=None) -> str | bool:
+    session = session or await sessions.get_session()
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + (key or get_key())}
     request = {
         "prompt": prompt,
         "n": 1,
-        "size": "1024x1024" #256x256, 512x512, or 1024x1024
+        "size": image_size
     }
-    print(f"Getting DALL-E image from prompt: {prompt}")
-    async with session.post(dalleurl, headers=headers, json=request) as response:
-        if response.ok:
-            url = (await response.json())["data"][0]['url']
-            filepath = filepath + ".png"
-            img_succ = await async_download_image(session, url, filepath)
-            return filepath if img_succ else False
-        else:
-            print('DALL-E Request Error: ' + await response.text())
-            return False
\ No newline at end of file
+    async def attempt():
+        print(f"Getting DALL-E image from prompt: {prompt}")
+        with metrics.track("openai", "dalle", image_size) as record:
+            async with session.post(dalleurl, headers=headers, json=request) as response:
+                record.first_byte(response.status)
+                if response.ok:
+                    body = await response.json()
+                    record.bytes = len(await response.read())
+                    record.images = len(body["data"])
+                    record.ok = True
+                    return body["data"][0]['url']
+                error = await response.text()
+                record.bytes = len(error)
+                resilience.raise_for_retry(response, error)
+                print('DALL-E Request Error: ' + error)
+                return False
+    url = await resilience.call("dalle", attempt, key)
+    if url is False:
+        return False
+    filepath = filepath + ".png"
+    img_succ = await async_download_image(session, url, filepath)
+    return filepath if img_succ else False
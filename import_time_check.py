@@ -0,0 +1,97 @@
+"""
+Checks that importing the project's modules is fast and has no side effects.
+Each module is imported in a fresh interpreter, inside an empty directory, with -X importtime.
+The check fails if an import goes over its time budget, loads a heavy dependency
+that should only be loaded on first use, or creates or reads files (eg database.db, key files).
+
+Run via
+python import_time_check.py
+Exits with status 1 if any check fails.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Cumulative import time budget per module, in milliseconds
+BUDGETS_MS = {
+    "gpt": 60,
+    "eleven": 60,
+    "database": 30,
+    "sessions": 40,
+    "resilience": 40,
+    "render": 30,
+    "Sequence": 100
+}
+# Dependencies that must not be loaded by importing the module
+FORBIDDEN_MODULES = ["moviepy", "aiohttp", "requests", "PIL", "numpy"]
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Prints the heavy modules that got loaded, the import time report goes to stderr
+CHILD_SCRIPT = '''
+import sys
+import {module}
+print(__import__("json").dumps(sorted(name for name in {forbidden}
+                                      if name in sys.modules)))
+'''
+
+def measure_import(module: str) -> dict:
+    """Imports the module in a fresh interpreter inside an empty directory.
+    Returns the cumulative import time in ms, the forbidden modules it loaded,
+    and the files it left behind."""
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, PYTHONPATH=REPO_PATH, PYTHONDONTWRITEBYTECODE='1')
+        script = CHILD_SCRIPT.format(module=module, forbidden=FORBIDDEN_MODULES)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                                cwd=directory, env=env, capture_output=True, text=True, check=False)
+        created = sorted(os.listdir(directory))
+    if result.returncode != 0:
+        return {"module": module, "error": result.stderr.strip().splitlines()[-1]}
+    # Lines look like "import time:      self [us] | cumulative | imported package"
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative_us = int(fields[1])
+    return {
+        "module": module,
+        "import_ms": cumulative_us / 1000,
+        "loaded": json.loads(result.stdout),
+        "created": created
+    }
+
+def check_module(module: str, budget_ms: float) -> list[str]:
+    """Returns the problems found when importing the module, an empty list if none."""
+    report = measure_import(module)
+    print(json.dumps(report))
+    if "error" in report:
+        return [f"{module}: import failed: {report['error']}"]
+    problems = []
+    if report["import_ms"] > budget_ms:
+        problems.append(f"{module}: import took {report['import_ms']:.1f}ms, budget is {budget_ms}ms")
+    if report["loaded"]:
+        problems.append(f"{module}: import loaded {', '.join(report['loaded'])}")
+    if report["created"]:
+        problems.append(f"{module}: import created {', '.join(report['created'])}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the import time budget of each module.")
+    parser.add_argument('modules', nargs='*', default=list(BUDGETS_MS),
+                        help="Modules to check, defaults to every module with a budget")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="Multiplies every budget, for slow machines")
+    args = parser.parse_args()
+
+    problems = []
+    for module in args.modules:
+        problems += check_module(module, BUDGETS_MS.get(module, 100) * args.scale)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""This module prepares generated images once, when they arrive:
+an export-sized frame for render.py, and small thumbnails for the editor.
+The decoding and resizing runs in a process pool so it doesn't hold up the event loop."""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+import render
+
+THUMBNAIL_SIZES = [256, 128]
+INGEST_WORKERS = 2
+
+_executor = None
+
+def get_executor() -> ProcessPoolExecutor:
+    """Returns the ingest process pool, creating it on first use."""
+    global _executor  # pylint: disable=W0603 # Global statement
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=INGEST_WORKERS)
+    return _executor
+
+def asset_paths(image_path: str, thumbnail_sizes: list[int]) -> dict[str, str]:
+    """Returns the paths of the assets derived from an image, next to the image.
+    Keys are "export" and "thumb_<size>"."""
+    base = os.path.splitext(image_path)[0]
+    paths = {"export": base + "_export.png"}
+    for size in thumbnail_sizes:
+        paths[f"thumb_{size}"] = base + f"_thumb{size}.jpg"
+    return paths
+
+# Runs in a worker process
+def normalize_image(image_path: str, export_size: tuple[int, int],
+                    thumbnail_sizes: list[int]) -> dict[str, str]:
+    """Writes the export frame and thumbnails of an image. Returns their paths."""
+    from PIL import Image   # pylint: disable=C0415 # Only needed in the worker processes
+    paths = asset_paths(image_path, thumbnail_sizes)
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        # Centered on black and cropped if larger, the same as render.py does at export time
+        (width, height) = export_size
+        crop_width = min(image.width, width)
+        crop_height = min(image.height, height)
+        left = (image.width - crop_width) // 2
+        top = (image.height - crop_height) // 2
+        frame = Image.new('RGB', (width, height), (0, 0, 0))
+        frame.paste(image.crop((left, top, left + crop_width, top + crop_height)),
+                    ((width - crop_width) // 2, (height - crop_height) // 2))
+        # Low compression, this file is read far more often than it's written
+        frame.save(paths["export"], compress_level=1)
+        for size in thumbnail_sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(paths[f"thumb_{size}"], quality=85)
+    return paths
+
+async def ingest_image(image_path: str, export_size: tuple[int, int] | None = None,
+                       thumbnail_sizes: list[int] | None = None) -> dict[str, str]:
+    """Produces the export frame and thumbnails of an image in the process pool.
+    Returns their paths, or an empty dict if the image couldn't be processed."""
+    export_size = tuple(export_size or render.RENDER_SETTINGS['size'])
+    thumbnail_sizes = thumbnail_sizes or THUMBNAIL_SIZES
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(get_executor(), normalize_image,
+                                          image_path, export_size, thumbnail_sizes)
+    except (OSError, ValueError) as error:
+        print(f"Image ingest error for {image_path}: {error}")
+        return {}
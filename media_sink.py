@@ -0,0 +1,149 @@
+"""This module contains the MediaSink class, which streams downloaded media to disk
+from a background thread, so file writes never block the event loop.
+Files are written to a temporary file and renamed into place when complete,
+so a failed or interrupted download never leaves a partial file at the final path."""
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# When to fsync: "never", "close" (once, before the rename), or "always" (after every chunk)
+FSYNC_POLICY = "close"
+# Chunks waiting to be written per sink. Downloads pause when their sink falls this far behind.
+MAX_PENDING_CHUNKS = 64
+WRITER_THREADS = 4
+
+_executor = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix='media_sink')
+
+# Totals across every sink, for throughput reporting
+total_bytes = 0
+total_write_seconds = 0.0
+
+class MediaSink:
+    """Async context manager that writes chunks to `filepath` on a background thread.
+
+    async with MediaSink(filepath) as sink:
+        async for chunk in response.content.iter_chunked(4096):
+            await sink.write(chunk)
+
+    The file only appears at `filepath` if the block finishes without raising."""
+    def __init__(self, filepath: str, fsync: str = FSYNC_POLICY):
+        if fsync not in ("never", "close", "always"):
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.filepath = filepath
+        self.fsync = fsync
+        self.bytes_written = 0
+        self.started = 0.0
+        self.finished = 0.0
+        self._temp_path = None
+        self._file = None
+        self._queue = None
+        self._writer = None
+        self._aborted = False
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        self.started = time.monotonic()
+        directory = os.path.dirname(self.filepath) or '.'
+        (fd, self._temp_path) = await loop.run_in_executor(
+            _executor, lambda: tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.filepath) + '.',
+                                                suffix='.part'))
+        self._file = os.fdopen(fd, 'wb')
+        self._queue = asyncio.Queue(MAX_PENDING_CHUNKS)
+        self._writer = asyncio.create_task(self._write_chunks())
+        return self
+
+    def _write_chunk(self, chunk: bytes):
+        self._file.write(chunk)
+        if self.fsync == "always":
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    async def _write_chunks(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await self._queue.get()
+            if chunk is None or self._aborted:
+                return
+            await loop.run_in_executor(_executor, self._write_chunk, chunk)
+            self.bytes_written += len(chunk)
+
+    # Waits for room in the queue, or for the writer to stop, whichever comes first.
+    # Otherwise a writer that failed (eg disk full) with a full queue would block the download forever.
+    async def _put(self, item):
+        if self._writer.done():
+            # The writer failed, surface its exception
+            await self._writer
+            raise RuntimeError(f"Writer of {self.filepath} stopped")
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(self._queue.put(item))
+        try:
+            await asyncio.wait((put, self._writer), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if put.done() and not put.cancelled():
+            return
+        await self._writer
+        raise RuntimeError(f"Writer of {self.filepath} stopped")
+
+    async def write(self, chunk: bytes):
+        """Queues a chunk to be written. Waits only if the writer has fallen behind.
+        Raises the writer's exception if it failed."""
+        await self._put(chunk)
+
+    def _commit(self):
+        self._file.flush()
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        # mkstemp files are private to the owner, give it normal file permissions
+        os.chmod(self._temp_path, 0o644)
+        os.replace(self._temp_path, self.filepath)
+
+    def _discard(self):
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        global total_bytes, total_write_seconds  # pylint: disable=W0603 # Global statement
+        loop = asyncio.get_running_loop()
+        if exc_type is None:
+            try:
+                await self._put(None)
+                await self._writer
+                await loop.run_in_executor(_executor, self._commit)
+            except BaseException:
+                await loop.run_in_executor(_executor, self._discard)
+                raise
+        else:
+            # Let the chunk being written finish, so the file isn't closed under the writer thread
+            self._aborted = True
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+            await asyncio.gather(self._writer, return_exceptions=True)
+            await loop.run_in_executor(_executor, self._discard)
+        self.finished = time.monotonic()
+        total_bytes += self.bytes_written
+        total_write_seconds += self.finished - self.started
+        return False
+
+    def bytes_per_second(self) -> float:
+        """Returns the write throughput of this sink, from opening to closing."""
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.bytes_written / elapsed if elapsed > 0 else 0.0
+
+def get_stats() -> dict:
+    """Returns the bytes written and average throughput of every finished sink."""
+    return {
+        "bytes": total_bytes,
+        "seconds": total_write_seconds,
+        "bytes_per_second": total_bytes / total_write_seconds if total_write_seconds > 0 else 0.0
+    }
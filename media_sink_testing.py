@@ -0,0 +1,68 @@
+"""
+This module is used for running test code to see if media_sink works as intended.
+This is not intended to be interfaced with in production.
+
+Run via
+python media_sink_testing.py
+Exits with status 1 if any test fails.
+"""
+import asyncio
+import errno
+import os
+import sys
+import tempfile
+import media_sink
+
+CHUNK = b'x' * 4096
+
+async def write_chunks(filepath, count):
+    async with media_sink.MediaSink(filepath) as sink:
+        for _ in range(count):
+            await sink.write(CHUNK)
+    return sink
+
+async def test_write():
+    """Tests that the chunks end up in the file, and only the file"""
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, 'out.bin')
+        sink = await write_chunks(filepath, 100)
+        assert sink.bytes_written == 100 * len(CHUNK)
+        assert os.path.getsize(filepath) == 100 * len(CHUNK)
+        assert os.listdir(directory) == ['out.bin']
+
+# A writer that fails while the queue is full must not leave the download waiting for room forever.
+async def test_failing_writer():
+    """Tests that a write error is raised by write() and leaves no file behind"""
+    def fail(self, chunk):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+    (write_chunk, max_pending) = (media_sink.MediaSink._write_chunk, media_sink.MAX_PENDING_CHUNKS)
+    media_sink.MediaSink._write_chunk = fail
+    media_sink.MAX_PENDING_CHUNKS = 4
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            filepath = os.path.join(directory, 'out.bin')
+            try:
+                await asyncio.wait_for(write_chunks(filepath, 100), timeout=5)
+            except OSError as error:
+                # asyncio.TimeoutError is an OSError too since Python 3.11, it means the write hung
+                assert error.errno == errno.ENOSPC, repr(error)
+            else:
+                raise AssertionError("write error wasn't raised")
+            assert os.listdir(directory) == [], os.listdir(directory)
+    finally:
+        media_sink.MediaSink._write_chunk = write_chunk
+        media_sink.MAX_PENDING_CHUNKS = max_pending
+
+async def main():
+    failed = 0
+    for test in (test_write, test_failing_writer):
+        try:
+            await test()
+            print(f"{test.__name__}: ok")
+        except (AssertionError, asyncio.TimeoutError) as error:
+            print(f"{test.__name__}: FAILED {type(error).__name__} {error}")
+            failed += 1
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""This module records every provider API request: what was asked for, how long it waited
+and took, how much came back, and what it's estimated to cost.
+Records are kept in memory and summarized per provider, sequence and user by get_metrics()."""
+import collections
+import contextlib
+import contextvars
+import time
+from dataclasses import dataclass, asdict
+
+# The most recent records kept for get_records(). The totals in get_metrics() cover every record.
+MAX_RECORDS = 10000
+
+# Estimated prices in dollars. Check the providers' pricing pages, these go out of date.
+# GPT: per 1000 (prompt, completion) tokens
+GPT_COSTS = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12)
+}
+# DALL-E: per image, by size
+DALLE_COSTS = {
+    "256x256": 0.016,
+    "512x512": 0.018,
+    "1024x1024": 0.02
+}
+# ElevenLabs: per 1000 characters
+ELEVENLABS_COST = 0.30
+
+# What the requests in the current task are for. Tasks inherit these from whoever created them.
+current_sequence = contextvars.ContextVar('current_sequence', default=None)
+current_user = contextvars.ContextVar('current_user', default=None)
+# Seconds the current call waited for an admission slot, set by the concurrent_* wrappers.
+# Taken by the call's first request, so retries don't count it again.
+queue_wait = contextvars.ContextVar('queue_wait', default=0.0)
+
+@dataclass
+class CallRecord:
+    """One request to a provider. Times are in seconds."""
+    provider: str           # "openai" or "elevenlabs"
+    operation: str          # "gpt", "dalle", "image_download", "tts", "tts_timestamps" or "voices"
+    model: str | None       # GPT model, DALL-E image size or ElevenLabs voice ID
+    sequence: str | None = None
+    user_id: int | None = None
+    started: float = 0.0    # Unix time
+    queue_wait: float = 0.0
+    ttfb: float | None = None   # Until the response headers arrived
+    latency: float = 0.0        # Until the response was fully read
+    status: int | None = None
+    ok: bool = False
+    bytes: int = 0              # Response body size
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    characters: int = 0
+    images: int = 0
+    cost: float = 0.0
+
+    def first_byte(self, status: int):
+        """Call when the response headers arrive."""
+        self.ttfb = time.time() - self.started
+        self.status = status
+
+    def estimate_cost(self) -> float:
+        if self.operation == "gpt" and self.model in GPT_COSTS:
+            (prompt_cost, completion_cost) = GPT_COSTS[self.model]
+            return (self.prompt_tokens * prompt_cost + self.completion_tokens * completion_cost) / 1000
+        if self.operation == "dalle":
+            return self.images * DALLE_COSTS.get(self.model, 0.0)
+        if self.operation in ("tts", "tts_timestamps"):
+            return self.characters * ELEVENLABS_COST / 1000
+        return 0.0
+
+records: collections.deque[CallRecord] = collections.deque(maxlen=MAX_RECORDS)
+# Summaries of every record ever made, grouped by ("provider" | "sequence" | "user", name)
+totals: dict[tuple[str, str], dict] = {}
+
+def new_summary() -> dict:
+    return {"calls": 0, "errors": 0, "queue_wait": 0.0, "ttfb": 0.0, "latency": 0.0,
+            "max_latency": 0.0, "bytes": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "characters": 0, "images": 0, "cost": 0.0}
+
+def add_to_summary(summary: dict, record: CallRecord):
+    summary["calls"] += 1
+    summary["errors"] += not record.ok
+    for field in ("queue_wait", "latency", "bytes", "prompt_tokens", "completion_tokens",
+                  "characters", "images", "cost"):
+        summary[field] += getattr(record, field)
+    summary["ttfb"] += record.ttfb or 0.0
+    summary["max_latency"] = max(summary["max_latency"], record.latency)
+
+def add_record(record: CallRecord):
+    records.append(record)
+    groups = [("provider", f"{record.provider}/{record.operation}"),
+              ("sequence", str(record.sequence)), ("user", str(record.user_id))]
+    for group in groups:
+        if group not in totals:
+            totals[group] = new_summary()
+        add_to_summary(totals[group], record)
+
+# with metrics.track("openai", "gpt", model) as record:
+#     async with session.post(...) as response:
+#         record.first_byte(response.status)
+#         ...
+#         record.ok = True
+# The record is saved when the block exits, even if it raises.
+@contextlib.contextmanager
+def track(provider: str, operation: str, model: str | None = None):
+    """Times one provider request and records it."""
+    record = CallRecord(provider, operation, model, current_sequence.get(), current_user.get(),
+                        time.time(), queue_wait.get())
+    queue_wait.set(0.0)
+    try:
+        yield record
+    finally:
+        record.latency = time.time() - record.started
+        record.cost = record.estimate_cost()
+        add_record(record)
+
+@contextlib.contextmanager
+def labels(sequence: str | None = None, user_id: int | None = None):
+    """Attributes the requests made inside the block, and the tasks started in it, to a sequence and user."""
+    tokens = (current_sequence.set(sequence), current_user.set(user_id))
+    try:
+        yield
+    finally:
+        current_sequence.reset(tokens[0])
+        current_user.reset(tokens[1])
+
+def summarize(summary: dict) -> dict:
+    """Adds averages to a summary."""
+    calls = summary["calls"] or 1
+    return dict(summary, avg_queue_wait=summary["queue_wait"] / calls,
+                avg_ttfb=summary["ttfb"] / calls, avg_latency=summary["latency"] / calls)
+
+def get_metrics() -> dict:
+    """Returns the request totals per provider operation, per sequence and per user."""
+    result = {"provider": {}, "sequence": {}, "user": {}}
+    for ((group, name), summary) in list(totals.items()):
+        result[group][name] = summarize(summary)
+    return result
+
+def get_records(sequence: str | None = None, user_id: int | None = None) -> list[dict]:
+    """Returns the most recent records, optionally only those of one sequence or user."""
+    return [asdict(record) for record in list(records)
+            if (sequence is None or record.sequence == sequence)
+            and (user_id is None or record.user_id == user_id)]
+
+def reset():
+    records.clear()
+    totals.clear()
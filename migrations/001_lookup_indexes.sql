@@ -0,0 +1,9 @@
+-- Indexes for the lookup paths in database.py that the UNIQUE constraints don't cover.
+
+-- get_segments, get_segment_from_index, get_segment_count, does_sequence_index_exist,
+-- and the index shifting UPDATEs in add_segment and change_segment_index.
+-- Not UNIQUE, the shifting UPDATEs pass through duplicate indices row by row.
+CREATE INDEX IF NOT EXISTS segments_sequence_order ON segments(sequence_id, sequence_index);
+
+-- does_sequence_name_exist without a user
+CREATE INDEX IF NOT EXISTS sequences_name ON sequences(sequence_name);
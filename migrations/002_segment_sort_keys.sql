@@ -0,0 +1,18 @@
+-- Segments are ordered by a sparse sort_key instead of a dense sequence_index,
+-- so inserting or moving a segment only changes that segment's row (see database.py -> new_sort_key()).
+-- sequence_index becomes the segment's rank by sort_key, computed when read.
+
+ALTER TABLE segments ADD COLUMN sort_key INTEGER NOT NULL DEFAULT 0;
+
+-- Keys 1024 apart in the old order. Duplicate indices (there was no UNIQUE) are ordered by id.
+UPDATE segments
+SET sort_key = 1024 * (1 + (SELECT COUNT(*) FROM segments AS other
+                            WHERE other.sequence_id = segments.sequence_id
+                                AND (other.sequence_index < segments.sequence_index
+                                    OR (other.sequence_index = segments.sequence_index
+                                        AND other.id < segments.id))));
+
+DROP INDEX segments_sequence_order;
+ALTER TABLE segments DROP COLUMN sequence_index;
+
+CREATE INDEX segments_sort_key ON segments(sequence_id, sort_key);
@@ -0,0 +1,12 @@
+-- Per segment, the last version allocated of each element, so add_segment_element
+-- can allocate the next one with a single UPDATE instead of counting the versions.
+
+ALTER TABLE segments ADD COLUMN text_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE segments ADD COLUMN image_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE segments ADD COLUMN audio_count INTEGER NOT NULL DEFAULT 0;
+
+-- Versions are numbered from 1 without gaps, MAX is the count
+UPDATE segments
+SET text_count = (SELECT COALESCE(MAX(version), 0) FROM segment_text WHERE segment_id = segments.id),
+    image_count = (SELECT COALESCE(MAX(version), 0) FROM segment_image WHERE segment_id = segments.id),
+    audio_count = (SELECT COALESCE(MAX(version), 0) FROM segment_audio WHERE segment_id = segments.id);
@@ -0,0 +1,225 @@
+"""
+This module is a local stand-in for the OpenAI and ElevenLabs APIs, for load testing
+the generation pipeline without spending money. It implements the endpoints used by
+gpt.py and eleven.py, with configurable latency, error and overload rates, and payload sizes.
+
+Run via
+python mock_provider.py --port 8080 --latency lognormal:0.8:0.5 --overload-rate 0.05
+then point the clients at it with
+OPENAI_BASE_URL=http://127.0.0.1:8080/v1 ELEVENLABS_BASE_URL=http://127.0.0.1:8080/v1
+(or gpt.set_base_url() and eleven.set_base_url()).
+"""
+import argparse
+import asyncio
+import base64
+import random
+import struct
+import time
+import uuid
+import zlib
+from dataclasses import dataclass
+from aiohttp import web
+
+WORDS = ("lettuce rainbow ocean mountain quiet bright ancient tiny golden river "
+         "forest shadow machine gentle storm city dream crystal paper window").split()
+
+# An MPEG-1 Layer III frame header: 128kbps, 44.1kHz, mono, no padding.
+# A frame of zeros after it decodes as 1152 samples of silence.
+MP3_FRAME = b'\xff\xfb\x90\xc4' + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+
+class Latency:
+    """A latency distribution parsed from a spec string:
+    "0.5" (fixed), "uniform:MIN:MAX", "normal:MEAN:STDDEV" or "lognormal:MEDIAN:SIGMA".
+    All values are in seconds."""
+    def __init__(self, spec: str):
+        parts = spec.split(':')
+        self.kind = parts[0] if len(parts) > 1 else "fixed"
+        self.values = [float(part) for part in (parts[1:] if len(parts) > 1 else parts)]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.values[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.values[0], self.values[1])
+        if self.kind == "normal":
+            return max(rng.gauss(self.values[0], self.values[1]), 0.0)
+        # lognormal, parameterized by its median
+        return rng.lognormvariate(0, self.values[1]) * self.values[0]
+
+@dataclass
+class MockSettings:
+    """Behavior of the mock server. Rates are probabilities between 0 and 1."""
+    gpt_latency: Latency
+    dalle_latency: Latency
+    download_latency: Latency
+    tts_latency: Latency
+    error_rate: float = 0.0
+    overload_rate: float = 0.0
+    retry_after: float = 1.0
+    completion_sentences: int = 5
+    image_size: int = 1024              # Width and height of generated PNGs
+    seconds_per_character: float = 0.06 # Length of generated audio
+    seed: int | None = None
+
+def make_png(size: int, rng: random.Random) -> bytes:
+    """Returns a noisy RGB PNG of size x size pixels."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    # One row of noise, shifted on every line so the image doesn't compress to nothing.
+    # Each row starts with filter type 0.
+    row = rng.randbytes(size * 3)
+    raw = b''.join(b'\x00' + row[y * 3:] + row[:y * 3] for y in range(size))
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+class MockProvider:
+    """The mock server's request handlers and state."""
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.rng = random.Random(settings.seed)
+        self.images: dict[str, bytes] = {}
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/images/generations', self.image_generations)
+        app.router.add_get('/images/{name}', self.download_image)
+        app.router.add_get('/v1/voices', self.voices)
+        app.router.add_post('/v1/text-to-speech/{voice_id}', self.text_to_speech)
+        app.router.add_post('/v1/text-to-speech/{voice_id}/with-timestamps', self.text_to_speech_with_timestamps)
+        return app
+
+    # Sleeps for the endpoint's latency, then returns an error response if one was rolled.
+    async def delay_and_fail(self, latency: Latency) -> web.Response | None:
+        self.requests += 1
+        await asyncio.sleep(latency.sample(self.rng))
+        roll = self.rng.random()
+        if roll < self.settings.overload_rate:
+            return web.json_response(
+                {"error": {"message": "That model is currently overloaded with other requests."}},
+                status=429, headers={'Retry-After': str(self.settings.retry_after)})
+        if roll < self.settings.overload_rate + self.settings.error_rate:
+            return web.json_response({"error": {"message": "Mock server error."}}, status=500)
+        return None
+
+    def sentence(self) -> str:
+        words = [self.rng.choice(WORDS) for _ in range(self.rng.randint(6, 14))]
+        return ' '.join(words).capitalize() + '.'
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        failure = await self.delay_and_fail(self.settings.gpt_latency)
+        if failure is not None:
+            return failure
+        content = '\n'.join(self.sentence() for _ in range(self.settings.completion_sentences))
+        prompt_tokens = sum(len(message['content']) for message in body['messages']) // 4
+        return web.json_response({
+            "id": "chatcmpl-" + uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body['model'],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4}
+        })
+
+    async def image_generations(self, request: web.Request) -> web.Response:
+        await request.json()
+        failure = await self.delay_and_fail(self.settings.dalle_latency)
+        if failure is not None:
+            return failure
+        name = uuid.uuid4().hex + '.png'
+        self.images[name] = make_png(self.settings.image_size, self.rng)
+        url = f"{request.scheme}://{request.host}/images/{name}"
+        return web.json_response({"created": int(time.time()), "data": [{"url": url}]})
+
+    async def download_image(self, request: web.Request) -> web.Response:
+        failure = await self.delay_and_fail(self.settings.download_latency)
+        if failure is not None:
+            return failure
+        image = self.images.pop(request.match_info['name'], None)
+        if image is None:
+            return web.Response(status=404, text="Image not found.")
+        return web.Response(body=image, content_type='image/png')
+
+    async def voices(self, _: web.Request) -> web.Response:
+        return web.json_response({"voices": [
+            {"voice_id": uuid.uuid5(uuid.NAMESPACE_OID, name).hex[:20], "name": name}
+            for name in ("Rachel", "Domi", "Bella", "Antoni")
+        ]})
+
+    async def text_to_speech(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        failure = await self.delay_and_fail(self.settings.tts_latency)
+        if failure is not None:
+            return failure
+        seconds = len(body['text']) * self.settings.seconds_per_character
+        frames = max(int(seconds / MP3_FRAME_SECONDS), 1)
+        response = web.StreamResponse(headers={'Content-Type': 'audio/mpeg'})
+        await response.prepare(request)
+        # Stream in chunks, like the real API
+        for start in range(0, frames, 64):
+            await response.write(MP3_FRAME * min(64, frames - start))
+        await response.write_eof()
+        return response
+
+    # Every character takes seconds_per_character, the same length as text_to_speech's audio.
+    async def text_to_speech_with_timestamps(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        failure = await self.delay_and_fail(self.settings.tts_latency)
+        if failure is not None:
+            return failure
+        text = body['text']
+        step = self.settings.seconds_per_character
+        frames = max(int(len(text) * step / MP3_FRAME_SECONDS), 1)
+        return web.json_response({
+            "audio_base64": base64.b64encode(MP3_FRAME * frames).decode('ascii'),
+            "alignment": {
+                "characters": list(text),
+                "character_start_times_seconds": [round(i * step, 3) for i in range(len(text))],
+                "character_end_times_seconds": [round((i + 1) * step, 3) for i in range(len(text))]
+            }
+        })
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI and ElevenLabs APIs.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', default='0.1',
+                        help="Default latency for every endpoint, eg 0.5, uniform:0.2:1, lognormal:0.8:0.5")
+    parser.add_argument('--gpt-latency')
+    parser.add_argument('--dalle-latency')
+    parser.add_argument('--download-latency')
+    parser.add_argument('--tts-latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Chance of a 500 response")
+    parser.add_argument('--overload-rate', type=float, default=0.0, help="Chance of a 429 overloaded response")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="Retry-After seconds on 429 responses")
+    parser.add_argument('--completion-sentences', type=int, default=5)
+    parser.add_argument('--image-size', type=int, default=1024)
+    parser.add_argument('--seconds-per-character', type=float, default=0.06)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        gpt_latency=Latency(args.gpt_latency or args.latency),
+        dalle_latency=Latency(args.dalle_latency or args.latency),
+        download_latency=Latency(args.download_latency or args.latency),
+        tts_latency=Latency(args.tts_latency or args.latency),
+        error_rate=args.error_rate,
+        overload_rate=args.overload_rate,
+        retry_after=args.retry_after,
+        completion_sentences=args.completion_sentences,
+        image_size=args.image_size,
+        seconds_per_character=args.seconds_per_character,
+        seed=args.seed
+    )
+    web.run_app(MockProvider(settings).app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """This module contains functions to assemble a video file from images and audio."""
 from moviepy.editor import AudioFileClip, ImageClip, \
     VideoFileClip, CompositeVideoClip, concatenate_videoclips, VideoClip
+import render
 
 def add_static_image_to_audio(image_path, 
                               audio_path, 
@@ -9,6 +10,11 @@ def add_static_image_to_audio(image_path,
     combining a static image that is located at `image_path` 
     with an audio file at `audio_path`.
     If no output path is specified, returns a VideoClip instance."""
+    # Writing a file doesn't need any per-frame work, let ffmpeg encode the still directly.
+    if output_path is not None:
+        render.render_still(image_path, audio_path, output_path,
+                            dict(render.RENDER_SETTINGS, size=None))
+        return None
     # create the audio clip object
     audio_clip = AudioFileClip(audio_path)
     # create the image clip object
@@ -19,13 +25,8 @@ def add_static_image_to_audio(image_path,
     video_clip.duration = audio_clip.duration
     # set the FPS to 1
     video_clip.fps = 5
-    # write the resuling video clip
-    if output_path is not None:
-        video_clip.write_videofile(output_path)
-        return None
     # return video file
-    else:
-        return video_clip
+    return video_clip
 
 # ia_tuple = (image_file_name, audio_file_name)
 def ia_tuple_to_clip(ia_tuple):
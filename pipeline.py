@@ -0,0 +1,103 @@
+"""This module contains the Pipeline class, which runs items through
+chained stages of async workers, lowest priority value first."""
+import asyncio
+import itertools
+import traceback
+
+class Stage:
+    """A pool of async workers that take items from a priority queue,
+    process them with the stage handler, and pass the results downstream."""
+    def __init__(self, name: str, handler, workers: int):
+        self.name = name
+        # async function that takes an item and returns the next stage's item,
+        # or False/None if the item should go no further.
+        self.handler = handler
+        self.workers = workers
+        self.downstream: list[Stage] = []
+        self.queue = None
+
+    def put(self, priority: int, order: int, item):
+        self.queue.put_nowait((priority, order, item))
+
+class Pipeline:
+    """Chains Stages together. Items keep their priority through every stage,
+    so with a segment index as the priority, the first segments finish first."""
+    def __init__(self):
+        self.stages: list[Stage] = []
+        self._order = itertools.count()
+        self._pending = []
+
+    def add_stage(self, name: str, handler, workers: int, after: str | None = None) -> Stage:
+        """Adds a stage. If `after` names an existing stage, this stage
+        receives that stage's results. Stages must be added upstream first."""
+        stage = Stage(name, handler, workers)
+        if after is not None:
+            self.get_stage(after).downstream.append(stage)
+        self.stages.append(stage)
+        return stage
+
+    def get_stage(self, name: str) -> Stage:
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    def put(self, stage_name: str, priority: int, item):
+        """Queues an item on a stage. Can be called before the pipeline runs."""
+        stage = self.get_stage(stage_name)
+        if stage.queue is None:
+            self._pending.append((stage, priority, item))
+        else:
+            stage.put(priority, next(self._order), item)
+
+    async def _work(self, stage: Stage, results: asyncio.Queue):
+        while True:
+            (priority, order, item) = await stage.queue.get()
+            try:
+                result = await stage.handler(item)
+            except Exception:   # pylint: disable=W0718 # One failed item shouldn't stop the pipeline
+                print(f"Pipeline stage '{stage.name}' failed:")
+                traceback.print_exc()
+                result = False
+            if result is not False and result is not None:
+                for next_stage in stage.downstream:
+                    next_stage.put(priority, order, result)
+            results.put_nowait((stage.name, priority, item, result))
+            stage.queue.task_done()
+
+    async def stream(self):
+        """Async generator that runs every stage and yields a
+        (stage name, priority, item, result) tuple whenever a handler finishes,
+        in completion order. Ends once all queued items have passed through the pipeline.
+        Failed handlers yield a result of False."""
+        for stage in self.stages:
+            stage.queue = asyncio.PriorityQueue()
+        for (stage, priority, item) in self._pending:
+            stage.put(priority, next(self._order), item)
+        self._pending = []
+        results = asyncio.Queue()
+        finished = object()
+        async def finish():
+            # Upstream stages hand their results on before marking an item done,
+            # so joining in the order stages were added waits for everything.
+            for stage in self.stages:
+                await stage.queue.join()
+            results.put_nowait(finished)
+        workers = [asyncio.create_task(self._work(stage, results))
+                   for stage in self.stages for _ in range(stage.workers)]
+        workers.append(asyncio.create_task(finish()))
+        try:
+            while True:
+                event = await results.get()
+                if event is finished:
+                    break
+                yield event
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def run(self):
+        """Runs every stage until all queued items have passed through the pipeline."""
+        async for _ in self.stream():
+            pass
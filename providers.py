@@ -0,0 +1,97 @@
+"""This module contains the ProviderRegistry, which hands out a client per (user, provider)
+holding that user's API key from the api_keys table and that user's own rate limits.
+Clients are cached, so the database is only read the first time a user calls a provider,
+and dropped when database.add_api_key changes the key.
+
+Note: a user without a stored key for a provider gets no client, and Sequence.py then sends
+their requests with the operator's keys in keys/, under the process-wide rate limits.
+Those requests are billed to the operator."""
+import threading
+import database
+from admission import AdmissionController
+
+# Provider names, the same as api_keys.key_type
+OPENAI = "openai"
+ELEVENLABS = "elevenlabs"
+
+# The budgets each user's client gets, per API:
+# name -> (max concurrent requests, requests per minute, tokens per minute). None means unlimited.
+CLIENT_LIMITS = {
+    OPENAI: {
+        "gpt": (3, 3500, 90000),
+        "dalle": (3, 50, None)
+    },
+    ELEVENLABS: {
+        "tts": (3, None, None)
+    }
+}
+
+class ProviderClient:
+    """One user's access to one provider: their API key and their own admission controllers,
+    so one user's burst only waits on that user's budget."""
+    def __init__(self, user_id: int, provider: str, key: str):
+        self.user_id = user_id
+        self.provider = provider
+        self.key = key
+        self.limiters = {
+            name: AdmissionController(f"{provider}/{name} (user {user_id})", *limits)
+            for (name, limits) in CLIENT_LIMITS[provider].items()
+        }
+
+    def limiter(self, name: str) -> AdmissionController:
+        """Returns the admission controller of one of the provider's APIs, eg "gpt"."""
+        return self.limiters[name]
+
+    def stats(self) -> list[dict]:
+        return [limiter.stats() for limiter in self.limiters.values()]
+
+class ProviderRegistry:
+    """Caches a ProviderClient per (user_id, provider).
+    Users without a key are cached too, as None, so they don't cost a lookup per request either.
+    None means the caller falls back to the operator's keys in keys/, billed to the operator."""
+    def __init__(self):
+        self._clients: dict[tuple[int, str], ProviderClient | None] = {}
+        self.lookups = 0
+        # Held from reading a key to caching its client, so an invalidate() from another thread
+        # (eg add_api_key in a Flask request) can't land in between and leave the old key cached.
+        self._lock = threading.Lock()
+
+    def get_client(self, user_id: int, provider: str) -> ProviderClient | None:
+        """Returns the user's client for the provider, or None if the user has no key for it."""
+        if provider not in CLIENT_LIMITS:
+            raise ValueError(f"Unknown provider: {provider}")
+        with self._lock:
+            if (user_id, provider) not in self._clients:
+                self.lookups += 1
+                key = database.get_api_key(user_id, provider)
+                self._clients[(user_id, provider)] = \
+                    ProviderClient(user_id, provider, key) if key else None
+            return self._clients[(user_id, provider)]
+
+    def invalidate(self, user_id: int, provider: str):
+        """Drops the cached client, the next request reads the key again.
+        Requests already holding the old client finish with the old key."""
+        with self._lock:
+            self._clients.pop((user_id, provider), None)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+    def stats(self) -> list[dict]:
+        """Returns the admission controller statistics of every cached client."""
+        with self._lock:
+            clients = list(self._clients.values())
+        return [stats for client in clients if client is not None
+                for stats in client.stats()]
+
+registry = ProviderRegistry()
+database.add_api_key_listener(registry.invalidate)
+
+def get_client(user_id: int | None, provider: str) -> ProviderClient | None:
+    """Returns the user's client for the provider from the process-wide registry.
+    None if there's no user or the user has no key for the provider,
+    in which case the operator's keys in keys/ are used (and billed)."""
+    if user_id is None:
+        return None
+    return registry.get_client(user_id, provider)
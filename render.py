@@ -0,0 +1,230 @@
+"""This module renders video clips for individual segments and joins them into a video.
+Rendered segment clips are cached in CLIP_PATH, so re-exporting a sequence only
+renders the segments that changed, and joining the clips doesn't re-encode them."""
+import concurrent.futures
+import hashlib
+import json
+import os
+import tempfile
+# pylint: disable=C0415 # Import outside toplevel, moviepy is slow to import and only needed when rendering
+
+CLIP_PATH = 'output/clips/'
+# Size cap of the clip cache. Past it, the least recently used clips are evicted after each export.
+# Like the generation cache, recency is kept in the files' modification times.
+MAX_CLIP_BYTES = 1024 * 1024 * 1024
+
+# Every clip that gets joined together must use the same settings,
+# otherwise they can't be joined without re-encoding.
+# "renderer" is "still" for the ffmpeg still image fast path, or "moviepy" for per-frame rendering.
+RENDER_SETTINGS = {
+    "renderer": "still",
+    "size": (1024, 1024),   # Images of other sizes are centered on black, like method='compose'.
+                            # None keeps each image's own size (still renderer only).
+    "fps": 5,
+    "codec": "libx264",
+    "audio_codec": "libmp3lame"
+}
+
+# Identifies a file by its path, modification time and size,
+# so replacing the file at the same path invalidates the clip.
+def file_signature(path: str | None) -> list | None:
+    """Returns a JSON serializable signature of the file at the path."""
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+def clip_key(image_path: str | None, audio_path: str, settings: dict) -> str:
+    """Returns the cache key of the clip rendered from these files and settings."""
+    request = {
+        "image": file_signature(image_path),
+        "audio": file_signature(audio_path),
+        "settings": settings
+    }
+    encoded = json.dumps(request, sort_keys=True)
+    return hashlib.sha256(encoded.encode('UTF-8')).hexdigest()
+
+def audio_duration(audio_path: str) -> float:
+    """Returns the duration of an audio file in seconds."""
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+    return ffmpeg_parse_infos(audio_path)['duration']
+
+# Segments are a single image held for the length of the audio, so there's no need to
+# build and composite every frame in Python. ffmpeg decodes and pads the image once,
+# then clones that frame for the duration (tpad), and x264's stillimage tuning
+# makes the repeated frames nearly free to encode.
+# An image_path of None renders a black frame.
+def run_ffmpeg(args: list[str]):
+    """Runs the ffmpeg binary moviepy is configured with."""
+    from moviepy.config import get_setting
+    from moviepy.tools import subprocess_call
+    subprocess_call([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error', *args], logger=None)
+
+def render_still(image_path: str | None, audio_path: str, output_path: str,
+                 settings: dict | None = None) -> str:
+    """Encodes a static image held for the duration of the audio, with the audio muxed in,
+    in a single ffmpeg call. Returns `output_path`."""
+    settings = settings or RENDER_SETTINGS
+    (width, height) = settings['size'] or RENDER_SETTINGS['size']
+    fps = settings['fps']
+    duration = audio_duration(audio_path)
+    if image_path is None:
+        video_input = ['-f', 'lavfi', '-i', f'color=c=black:s={width}x{height}:r={fps}:d={1 / fps}']
+    else:
+        video_input = ['-framerate', str(fps), '-i', image_path]
+    if settings['size'] is None:
+        # yuv420p needs even dimensions
+        video_filter = "pad=ceil(iw/2)*2:ceil(ih/2)*2"
+    else:
+        # Center on a black frame of the export size, cropping images that are larger
+        video_filter = (f"crop='min(iw,{width})':'min(ih,{height})',"
+                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:black")
+    video_filter += f",format=yuv420p,tpad=stop_mode=clone:stop_duration={duration}"
+    # Stereo 44.1kHz audio, the same as moviepy writes
+    run_ffmpeg([*video_input, '-i', audio_path,
+                '-map', '0:v', '-map', '1:a', '-vf', video_filter, '-r', str(fps),
+                '-c:v', settings['codec'], '-tune', 'stillimage',
+                '-c:a', settings['audio_codec'], '-ar', '44100', '-ac', '2',
+                '-t', str(duration), output_path])
+    return output_path
+
+def render_moviepy(image_path: str | None, audio_path: str, output_path: str,
+                   settings: dict | None = None) -> str:
+    """Renders a static image held for the duration of the audio frame by frame with moviepy.
+    Returns `output_path`."""
+    import moviepy.editor as mov
+    settings = settings or RENDER_SETTINGS
+    size = tuple(settings['size'])
+    audio_clip = mov.AudioFileClip(audio_path)
+    if image_path is None:
+        image_clip = mov.ColorClip(size=size, color=(0, 0, 0))
+    else:
+        image_clip = mov.ImageClip(image_path)
+        if tuple(image_clip.size) != size:
+            image_clip = image_clip.on_color(size=size, color=(0, 0, 0))
+    video_clip = image_clip.set_audio(audio_clip).set_duration(audio_clip.duration)
+    video_clip.write_videofile(output_path, fps=settings['fps'], codec=settings['codec'],
+                               audio_codec=settings['audio_codec'],
+                               temp_audiofile=output_path + '.mp3', logger=None)
+    audio_clip.close()
+    return output_path
+
+# An image_path of None renders a black frame.
+def render_segment_clip(image_path: str | None, audio_path: str,
+                        settings: dict | None = None) -> str:
+    """Renders a static image held for the duration of the audio to a video file.
+    Returns the path of the rendered clip, which is reused if it already exists."""
+    settings = settings or RENDER_SETTINGS
+    os.makedirs(CLIP_PATH, exist_ok=True)
+    key = clip_key(image_path, audio_path, settings)
+    clip_path = CLIP_PATH + key + '.mp4'
+    try:
+        # Marks it as recently used for evict_clips()
+        os.utime(clip_path)
+        return clip_path
+    except FileNotFoundError:
+        pass
+    # Render next to the final path and move it in place,
+    # so an interrupted render never leaves a broken clip in the cache.
+    # The temporary name is unique, so two exports rendering the same clip don't share it,
+    # and starts with '.', so evict_clips() leaves it alone.
+    (fd, temp_path) = tempfile.mkstemp(dir=CLIP_PATH, prefix='.' + key + '.', suffix='.part.mp4')
+    os.close(fd)
+    try:
+        if settings['renderer'] == 'still':
+            render_still(image_path, audio_path, temp_path, settings)
+        else:
+            render_moviepy(image_path, audio_path, temp_path, settings)
+        os.replace(temp_path, clip_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return clip_path
+
+# workers > 1 renders clips in a pool of processes, since each render is mostly
+# single threaded Python and ffmpeg work. The clips are identical either way.
+def render_segment_clips(media: list[tuple[str | None, str]],
+                         settings: dict | None = None, workers: int = 1) -> list[str]:
+    """Renders a clip for every (image path, audio path) pair, reusing cached clips.
+    Returns the clip paths in the same order as `media`."""
+    settings = settings or RENDER_SETTINGS
+    if workers <= 1:
+        clip_paths = [render_segment_clip(image_path, audio_path, settings)
+                      for (image_path, audio_path) in media]
+        evict_clips(keep=clip_paths)
+        return clip_paths
+    # Only send out clips that aren't cached yet, and each one only once.
+    missing = []
+    for (image_path, audio_path) in media:
+        clip_path = CLIP_PATH + clip_key(image_path, audio_path, settings) + '.mp4'
+        if not os.path.exists(clip_path) and (image_path, audio_path) not in missing:
+            missing.append((image_path, audio_path))
+    if missing:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(missing))) as pool:
+            futures = [pool.submit(render_segment_clip, image_path, audio_path, settings)
+                       for (image_path, audio_path) in missing]
+            for future in futures:
+                future.result()
+    clip_paths = [render_segment_clip(image_path, audio_path, settings)
+                  for (image_path, audio_path) in media]
+    evict_clips(keep=clip_paths)
+    return clip_paths
+
+# The clips of the export that just rendered are the most recently used,
+# and are passed as `keep` so they survive even if they alone are over the cap.
+def evict_clips(max_bytes: int | None = None, keep: list[str] = ()) -> int:
+    """Deletes the least recently used clips until the clip cache fits in `max_bytes`
+    (MAX_CLIP_BYTES by default). Returns the number of bytes freed."""
+    max_bytes = MAX_CLIP_BYTES if max_bytes is None else max_bytes
+    keep = {os.path.abspath(path) for path in keep}
+    found = []
+    total_bytes = 0
+    for filename in os.listdir(CLIP_PATH):
+        if filename.startswith('.'):
+            # Render in progress
+            continue
+        path = os.path.join(CLIP_PATH, filename)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        found.append((stat.st_mtime, path, stat.st_size))
+        total_bytes += stat.st_size
+    found.sort()
+    freed = 0
+    for (_, path, size) in found:
+        if total_bytes - freed <= max_bytes:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        freed += size
+    return freed
+
+def slice_audio(audio_path: str, output_path: str, start: float, end: float | None = None) -> str:
+    """Writes the part of the audio from `start` to `end` seconds (or the end of the audio)
+    to an mp3 file. Returns `output_path`."""
+    duration = ['-t', str(end - start)] if end is not None else []
+    run_ffmpeg(['-i', audio_path, '-ss', str(start), *duration,
+                '-c:a', 'libmp3lame', output_path])
+    return output_path
+
+def concat_clips(clip_paths: list[str], output_path: str) -> str:
+    """Joins rendered clips into one video file without re-encoding them.
+    The clips must have been rendered with the same settings. Returns `output_path`."""
+    list_path = output_path + '.txt'
+    with open(list_path, 'w', encoding='UTF-8') as file:
+        for clip_path in clip_paths:
+            escaped = os.path.abspath(clip_path).replace("'", "'\\''")
+            file.write(f"file '{escaped}'\n")
+    try:
+        run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', output_path])
+    finally:
+        os.remove(list_path)
+    return output_path
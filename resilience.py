@@ -0,0 +1,153 @@
+"""This module contains the retry and circuit breaker logic shared by every async API call.
+Failed requests are retried a limited number of times with exponential backoff and jitter,
+and a provider that keeps failing is skipped for a while instead of being hammered."""
+# pylint: disable=C0415 # Import outside toplevel, aiohttp is imported on first use
+import asyncio
+import email.utils
+import hashlib
+import random
+import time
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import aiohttp
+
+MAX_ATTEMPTS = 5
+# Backoff delays in seconds. The delay before retry n is random between 0 and BASE_DELAY * 2^n.
+BASE_DELAY = 1.0
+MAX_DELAY = 30.0
+# Longest Retry-After header we'll honor, in seconds
+MAX_RETRY_AFTER = 60.0
+# Consecutive failures before a provider's circuit opens,
+# and seconds before a single trial request is let through again.
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+
+# HTTP statuses that may succeed if tried again later
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# Error messages that may succeed if tried again later
+RETRY_MESSAGES = ["That model is currently overloaded with other requests"]
+
+class RetryableError(Exception):
+    """Raised by a request attempt that failed in a way that may succeed later."""
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Tracks failures of one provider.
+    Closed: requests go through. Open: requests fail fast.
+    Half open: after RESET_TIMEOUT, one trial request decides whether to close or reopen."""
+    def __init__(self, name: str, failure_threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout: float = RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        """Returns true if a request may be sent now."""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                print(f"{self.name} circuit opened after {self.failures} failures.")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    # The request ended without telling us anything about the provider, eg it was cancelled.
+    def abandon(self):
+        self.trial_in_flight = False
+
+breakers: dict[str, CircuitBreaker] = {}
+
+# Each API key gets its own breaker, so one user running out of quota on their key
+# doesn't make every other user's requests fail fast. None is the keys/ files' key.
+# The name has a hash of the key, never the key itself, since it's printed.
+def get_breaker(provider: str, key: str | None = None) -> CircuitBreaker:
+    """Returns the circuit breaker of the provider and API key, creating it if needed."""
+    name = provider
+    if key is not None:
+        name += f" (key {hashlib.sha256(key.encode('UTF-8')).hexdigest()[:8]})"
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+def retry_after_seconds(headers) -> float | None:
+    """Returns the delay requested by a Retry-After header in seconds, or None."""
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+def raise_for_retry(response: 'aiohttp.ClientResponse', error_text: str):
+    """Raises RetryableError if a failed response may succeed if tried again later."""
+    if response.status in RETRY_STATUSES \
+            or any(message in error_text for message in RETRY_MESSAGES):
+        raise RetryableError(f"{response.status} {error_text}", retry_after_seconds(response.headers))
+
+# "Full jitter" backoff, so retries from many requests don't all land at the same time.
+def backoff_delay(attempt: int) -> float:
+    """Returns the delay in seconds before retrying after the given failed attempt (from 0)."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+# `attempt` is an async function that sends the request once. It returns the result,
+# False on a failure that won't be fixed by retrying, or raises RetryableError.
+# Connection errors and timeouts are retried too.
+# `key` is the API key the request is sent with, see get_breaker().
+async def call(provider: str, attempt, key: str | None = None):
+    """Runs `attempt` with bounded retries and the circuit breaker of the provider and key.
+    Returns its result, or False if the provider is down or every attempt failed."""
+    import aiohttp
+    breaker = get_breaker(provider, key)
+    for attempt_number in range(MAX_ATTEMPTS):
+        if not breaker.allow():
+            print(f"{breaker.name} circuit is open, failing fast.")
+            return False
+        try:
+            result = await attempt()
+        except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+            breaker.record_failure()
+            if attempt_number + 1 == MAX_ATTEMPTS:
+                print(f"{provider} request failed after {MAX_ATTEMPTS} attempts: {error}")
+                return False
+            retry_after = getattr(error, 'retry_after', None)
+            if retry_after is not None:
+                delay = min(retry_after, MAX_RETRY_AFTER)
+            else:
+                delay = backoff_delay(attempt_number)
+            print(f"{provider} request failed ({error}), retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            breaker.abandon()
+            raise
+        # The provider answered, even if it was a non-retryable error
+        breaker.record_success()
+        return result
+    return False
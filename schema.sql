@@ -1,5 +1,7 @@
 -- DATABASE SCHEMA for sqlite3
 -- Runs on database.py -> init_database()
+-- Don't change existing tables here, databases already created won't pick it up.
+-- Add a migration in migrations/ instead, see database.py -> migrate()
 -- table names standard plural
 
 PRAGMA foreign_keys = ON;
@@ -200,8 +200,12 @@ TODO later
 # Currently run via
 # python -m flask --app server run
 # http://127.0.0.1:5000 by default
-from flask import Flask, request, send_file, render_template
+from flask import Flask, request, send_file, render_template, abort
 from markupsafe import escape # for escaping user input
+import database
+import media_sink
+import metrics
+import Sequence
 
 app = Flask(__name__, template_folder='www')
 
@@ -230,17 +234,29 @@ def test_post():
     data = request.data
     return f'Received POST request with data: {data}'
 
-
-# @app.route("/api/projects/<int:project_id>", methods=['GET', 'POST'])
-# def project_root(project_id):
-#     if request.method == "POST":
-#         # In the future, edit name or delete project
-#         return "no"
-#     if request.method == "GET":
-#         return {
-            
-#         }
+# Provider request totals (latency, queue wait, bytes, tokens, estimated cost) per provider,
+# sequence and user, with the rate limiter, cache, coalesced request and download statistics.
+# ?records=1 adds the most recent individual requests, filtered by ?sequence= and ?user_id=
+@app.route("/api/metrics")
+def get_metrics():
+    result = {
+        "requests": metrics.get_metrics(),
+        "limiters": Sequence.get_limiter_stats(),
+        "cache": Sequence.get_cache_stats(),
+        "flights": Sequence.flights.stats(),
+        "media": media_sink.get_stats()
+    }
+    if request.args.get('records'):
+        result["records"] = metrics.get_records(request.args.get('sequence'),
+                                                request.args.get('user_id', type=int))
+    return result
 
 
-# def get_project(project_id):
-#     pass
\ No newline at end of file
+# Returns {"name": name, "id": id, "script": "script", "sequence": list[Segment]}
+# In the future, POST to edit the name or delete the project
+@app.route("/api/projects/<int:project_id>")
+def get_project(project_id):
+    project = database.get_project(project_id)
+    if project is None:
+        abort(404)
+    return project
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""This module contains the SessionManager class, which shares one pooled aiohttp
+session between every Sequence and API call in the process, so connections
+(and their TLS handshakes and DNS lookups) are reused instead of rebuilt per project."""
+# pylint: disable=C0415 # Import outside toplevel, aiohttp is imported on first use
+import asyncio
+import weakref
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    import aiohttp
+
+# Connection pool settings
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 20
+DNS_CACHE_SECONDS = 300
+KEEPALIVE_SECONDS = 30
+# Timeouts in seconds. DALL-E and long TTS requests can take a while.
+TOTAL_TIMEOUT = 300
+CONNECT_TIMEOUT = 10
+
+class SessionManager:
+    """Hands out one shared aiohttp.ClientSession per event loop.
+    Sessions are created on first use and stay open until close() is called."""
+    def __init__(self):
+        # aiohttp sessions belong to the event loop they were created in
+        self._sessions = weakref.WeakKeyDictionary()
+
+    async def get_session(self) -> 'aiohttp.ClientSession':
+        """Returns the shared session for the running event loop, creating it if needed."""
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS,
+                                             limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                                             ttl_dns_cache=DNS_CACHE_SECONDS,
+                                             keepalive_timeout=KEEPALIVE_SECONDS)
+            timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT, connect=CONNECT_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        """Closes the shared session of the running event loop. Call on shutdown."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+session_manager = SessionManager()
+
+async def get_session() -> 'aiohttp.ClientSession':
+    """Returns the process-wide shared session for the running event loop."""
+    return await session_manager.get_session()
+
+async def close():
+    """Closes the process-wide shared session for the running event loop."""
+    await session_manager.close()
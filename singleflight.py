@@ -0,0 +1,48 @@
+"""This module contains the SingleFlight class, which coalesces identical calls that are
+running at the same time into one, eg the same API request fired twice by a double-click."""
+import asyncio
+
+class SingleFlight:
+    """Runs at most one call per key at a time.
+    A caller asking for a key that is already running waits for that call and gets its result
+    (or exception), instead of starting its own. Once the call finishes, the key is free again.
+    The call is cancelled only when every caller waiting on it has been cancelled."""
+    def __init__(self):
+        # key -> [task, number of callers waiting on it]
+        self._calls = {}
+        # Statistics
+        self.started = 0
+        self.joined = 0
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight(), "started": self.started, "joined": self.joined}
+
+    def _forget(self, key, task):
+        call = self._calls.get(key)
+        if call is not None and call[0] is task:
+            del self._calls[key]
+
+    # `factory` is called with no arguments and returns the coroutine to run,
+    # only if no call with the same key is running. The key must be hashable.
+    # The call runs in a task with a copy of the first caller's context.
+    async def do(self, key, factory):
+        """Returns the result of the running call for `key`, starting it with `factory()` if there is none."""
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(factory())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.started += 1
+        else:
+            self.joined += 1
+        call[1] += 1
+        try:
+            # Shielded, so one caller being cancelled doesn't cancel the call for the others
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not call[0].done():
+                call[0].cancel()